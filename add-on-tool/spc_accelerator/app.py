@@ -1,13 +1,17 @@
-from spc_accelerator.utils import pull_worksheet_data
+from spc_accelerator.utils import pull_worksheet_data, capsule_properties
 from spc_accelerator.frontend import frontend
 from spc_accelerator.backend import *
 import ipywidgets as ipw
 import ipyvuetify as v
 from IPython.display import display
+import asyncio
+import threading
 
 
 class SPCAccelerator:
     DOCS_URL = "https://seeq12.github.io/seeq-add-on-spc-accelerator/user_guide.html"
+    # number of signals processed concurrently, the per signal work is mostly waiting on the server
+    MAX_WORKERS = 8
     ADDITIONAL_CSS = """
     .jp-Notebook {
         padding: 0px !important;
@@ -63,6 +67,7 @@ class SPCAccelerator:
             self.end_time,
             self.signals,
             self.conditions,
+            self.catalog,
         ) = pull_worksheet_data(self.URL, self.workbook_id, self.worksheet_id)
 
         (
@@ -76,49 +81,104 @@ class SPCAccelerator:
             self.apply_to_condition,
             self.control_chart,
             self.we_runrules,
+            self.we_rules,
             self.nelson_runrules,
+            self.nelson_rules,
             self.histogram,
+            self.summary_worksheets,
+            self.archive_superseded,
             self.button,
+            self.cancel_button,
             self.workbook_button,
             self.error,
             self.success,
         ) = frontend(
             self.signal_list, self.condition_list, self.start_time, self.end_time
         )
-        self.button.on_event(
-            "click", lambda widget, event, data: self.input_validation()
-        )
+        self.cancel_event = None
+        self.button.on_event("click", lambda widget, event, data: self.execute())
+        self.cancel_button.on_event("click", lambda widget, event, data: self.cancel())
         self.input_condition.on_event(
             "change", lambda widget, event, data: self.check_properties()
         )
 
-    def input_validation(self):
+    def validate_inputs(self):
         self.success.value = False
         self.input_signal = check_input_signal(self.input_signal)
         self.error = check_training_window(
             self.end_select, self.start_select, self.error
         )
+        return (self.input_signal.error == False) and (self.error.value == False)
+
+    def run_options(self):
+        # options shared by the blocking and the non-blocking run
+        return dict(
+            batch_push=True,
+            max_workers=SPCAccelerator.MAX_WORKERS,
+            targeted_template=True,
+            summary_worksheets=self.summary_worksheets.v_model == True,
+            archive_superseded=self.archive_superseded.v_model == True,
+        )
+
+    def reset_buttons(self):
+        self.button.disabled = False
+        self.button.loading = False
+        self.cancel_button.disabled = True
+        self.cancel_button.loading = False
 
-        if (self.input_signal.error == False) and (self.error.value == False):
-            self.workbook_button, self.success, self.button = create_control_chart(self)
+    def input_validation(self):
+        if self.validate_inputs():
+            try:
+                (
+                    self.workbook_button,
+                    self.success,
+                    self.button,
+                    self.generated_items,
+                ) = create_control_chart(self, **self.run_options())
+            finally:
+                self.reset_buttons()
+
+    def execute(self):
+        # runs the pipeline without blocking the kernel so the UI stays responsive and can cancel
+        if self.validate_inputs():
+            self.cancel_event = threading.Event()
+            asyncio.ensure_future(self.run_async())
+
+    async def run_async(self):
+        self.cancel_button.disabled = False
+        try:
+            (
+                self.workbook_button,
+                self.success,
+                self.button,
+                self.generated_items,
+            ) = await create_control_chart_async(
+                self, cancel_event=self.cancel_event, **self.run_options()
+            )
+        except Exception as e:
+            # the task is not awaited by anyone, so an error is shown in the alert instead of
+            # being dropped with the task
+            self.success.children = [f"Run failed: {e}"]
+            self.success.type = "error"
+            self.success.value = True
+        finally:
+            # a failed or cancelled run must not leave the buttons loading
+            self.reset_buttons()
+
+    def cancel(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.loading = True
 
     def check_properties(self):
         "Adding single line doctsring"
         if isinstance(self.input_condition.v_model, str):
             self.apply_to_condition.disabled = False
-            capsules = spy.pull(
-                self.conditions[
-                    self.conditions["Name"] == self.input_condition.v_model
-                ],
-                start=self.start_select.value,
-                end=self.end_select.value,
-                quiet=True,
+            property_list = capsule_properties.names(
+                self.catalog.item(self.input_condition.v_model),
+                self.start_select.value,
+                self.end_select.value,
             )
-            property_list = capsules.columns.to_list()
-            property_list = [s for s in property_list if s != "Condition"]
-            property_list = [s for s in property_list if s != "Capsule Start"]
-            property_list = [s for s in property_list if s != "Capsule End"]
-            property_list = [s for s in property_list if s != "Capsule Is Uncertain"]
             self.capsule_property.v_model = property_list
             self.capsule_property.items = property_list
             set_apply_to_condition(self.apply_to_condition, self.input_condition)
@@ -191,8 +251,12 @@ class SPCAccelerator:
                                 children=[
                                     self.control_chart,
                                     self.we_runrules,
+                                    self.we_rules,
                                     self.nelson_runrules,
+                                    self.nelson_rules,
                                     self.histogram,
+                                    self.summary_worksheets,
+                                    self.archive_superseded,
                                 ],
                             ),
                             v.Html(
@@ -200,6 +264,7 @@ class SPCAccelerator:
                                 class_="d-flex flex-row execute-container",
                                 children=[
                                     self.button,
+                                    self.cancel_button,
                                     self.workbook_button,
                                 ],
                             ),
@@ -2,9 +2,23 @@ from seeq import spy
 from seeq import sdk
 import pandas as pd
 import json
+import hashlib
 import re
 import math
-from spc_accelerator.templates import create_template, format_histogram_worksheet
+import asyncio
+import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from spc_accelerator.catalog import ItemCatalog
+from spc_accelerator.moments import MomentAccumulator
+from spc_accelerator.planner import TaskGraph, RunCancelled
+from spc_accelerator.registry import RUN_ID_PROPERTY, RunRegistry
+from spc_accelerator.templates import (
+    SUMMARY_SIGNALS,
+    create_template,
+    histogram_worksheets,
+)
+from spc_accelerator.utils import API_ERRORS, capsule_properties
 
 # when deploying a test instance, need to append a suffix to the formula package names to prevent collisons
 try:
@@ -18,17 +32,99 @@ workbooks_api = sdk.WorkbooksApi(spy.client)
 formulaAPI = sdk.FormulasApi(spy.client)
 itemsAPI = sdk.ItemsApi(spy.client)
 
+# length of the time shards raw samples are pulled in when statistics are computed locally
+SAMPLE_SHARD = pd.Timedelta(days=7)
+# number of histogram functions created and run concurrently
+HISTOGRAM_WORKERS = 8
+# item property holding the hash of the formula, parameters and training window an item was pushed with
+CONTENT_HASH_PROPERTY = "SPC Content Hash"
+# formula a plan shows for frozen limits, their constants are only read from the server by the run
+COMPUTED_AT_RUN_TIME = "//Computed at run time from the training window statistics"
+# limit lines in the order create_limit_signals creates them and the worksheet layout expects
+LIMIT_NAMES = ["+1 Sigma", "-1 Sigma", "+2 Sigma", "-2 Sigma", "+3 Sigma", "-3 Sigma"]
+# the mean and limit lines each run rule is evaluated against
+WESTERN_ELECTRIC_RULE_LIMITS = {
+    1: ["-3 Sigma", "+3 Sigma"],
+    2: ["-2 Sigma", "+2 Sigma"],
+    3: ["-1 Sigma", "+1 Sigma"],
+    4: ["Mean"],
+}
+NELSON_RULE_LIMITS = {
+    1: ["-3 Sigma", "+3 Sigma"],
+    2: ["Mean"],
+    3: [],
+    4: [],
+    5: ["-2 Sigma", "+2 Sigma"],
+    6: ["-1 Sigma", "+1 Sigma"],
+    7: ["-1 Sigma", "+1 Sigma"],
+    8: ["-1 Sigma", "+1 Sigma"],
+}
+RULE_LIMITS = {
+    "Western Electric": WESTERN_ELECTRIC_RULE_LIMITS,
+    "Nelson": NELSON_RULE_LIMITS,
+}
+# formula package of each rule set, the combined mode calls its AllRules function
+RULE_PACKAGES = {
+    "Western Electric": "WesternElectricRunRules",
+    "Nelson": "NelsonRunRules",
+}
 
-def create_control_chart(*args):
+
+async def create_control_chart_async(
+    *args, batch_push=False, max_workers=1, cancel_event=None, **options
+):
+    # the pipeline runs on a worker thread so the notebook event loop keeps serving the
+    # widgets, progress is streamed into the success alert by the pipeline itself
+    instance = args[0]
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            None,
+            functools.partial(
+                create_control_chart,
+                *args,
+                batch_push=batch_push,
+                max_workers=max_workers,
+                cancel_event=cancel_event,
+                **options,
+            ),
+        )
+    except RunCancelled as e:
+        # a cancelled run whose items could not be registered says so, they are not archived later
+        instance.success.children = [
+            "Run cancelled. Items that were already pushed are kept in the workbook."
+            + (f" {e}." if str(e) else "")
+        ]
+        instance.success.type = "warning"
+        instance.success.value = True
+        return instance.workbook_button, instance.success, instance.button, None
+
+
+def create_control_chart(
+    *args,
+    batch_push=False,
+    max_workers=1,
+    cancel_event=None,
+    dry_run=False,
+    property_values=None,
+    min_grade_capsules=1,
+    freeze_limits=False,
+    lean_limits=False,
+    combined_rules=False,
+    scope_rules=False,
+    episode_duration=None,
+    targeted_template=False,
+    summary_worksheets=False,
+    archive_superseded=False,
+):
     if len(args) == 1:
         instance = args[0]
         URL = instance.URL
         workbook_id = instance.workbook_id
         worksheet_id = instance.worksheet_id
         signal_list = instance.signal_list
-        signals = instance.signals
         condition_list = instance.condition_list
-        conditions = instance.conditions
+        catalog = instance.catalog
         start_time = instance.start_time
         end_time = instance.end_time
         input_signal = instance.input_signal
@@ -41,6 +137,8 @@ def create_control_chart(*args):
         control_chart = instance.control_chart
         we_runrules = instance.we_runrules
         nelson_runrules = instance.nelson_runrules
+        we_rules = instance.we_rules
+        nelson_rules = instance.nelson_rules
         histogram = instance.histogram
         button = instance.button
         workbook_button = instance.workbook_button
@@ -48,9 +146,6 @@ def create_control_chart(*args):
         success = instance.success
         input_condition = instance.input_condition
 
-    workbook_button.disabled = True
-    button.disabled = True
-    button.loading = True
     capsule_start = re.sub(" ", "T", str(start_select.value))
     capsule_end = re.sub(" ", "T", str(end_select.value))
     units_lookup_dict = {
@@ -63,160 +158,867 @@ def create_control_chart(*args):
     for word, unit in units_lookup_dict.items():
         unit_str = unit_str.replace(word, unit)
     interp_value = str(signal_interpolation.v_model) + unit_str
-    num_completed = 0
-    signals_completed = ""
-    display_dict = {}
-    histogram_dict = {}
+    created_string = create_output_string(we_runrules, nelson_runrules, histogram)
+    if (
+        dry_run
+        and isinstance(capsule_property.v_model, str)
+        and property_values is None
+    ):
+        raise ValueError(
+            "Planning with a capsule property needs its values, pass them as property_values."
+        )
+
+    # every item and worksheet of the run is registered under this ID
+    run_id = uuid.uuid4().hex
+    graph, histogram_dict, unchanged_items, worksheet_ids = create_run_graph(
+        signal_names=input_signal.v_model,
+        capsule_start=capsule_start,
+        capsule_end=capsule_end,
+        input_condition=input_condition,
+        capsule_property=capsule_property,
+        catalog=catalog,
+        start_select=start_select,
+        end_select=end_select,
+        apply_to_condition=apply_to_condition,
+        rule_sets=selected_rule_sets(
+            we_runrules, nelson_runrules, we_rules, nelson_rules
+        ),
+        histogram=histogram,
+        interp_value=interp_value,
+        URL=URL,
+        workbook_id=workbook_id,
+        workbook_button=workbook_button,
+        batch_push=batch_push,
+        dry_run=dry_run,
+        property_values=property_values,
+        min_grade_capsules=min_grade_capsules,
+        freeze_limits=freeze_limits,
+        lean_limits=lean_limits,
+        combined_rules=combined_rules,
+        scope_rules=scope_rules,
+        episode_duration=episode_duration,
+        targeted_template=targeted_template,
+        summary_worksheets=summary_worksheets,
+        run_id=run_id,
+    )
+
+    if dry_run:
+        # only the formula builders run, nothing is read from or written to the server
+        graph.run(max_workers)
+        return run_plan(graph)
+
+    workbook_button.disabled = True
+    button.disabled = True
+    button.loading = True
+    success.type = "success"
+    signals_completed = []
+
+    def signal_progress(task_name):
+        # a signal is completed once all its nodes are done. In batch mode its items only reach
+        # the server with the Push Items node, so nothing is completed before that node finished
+        if batch_push and graph.status("Push Items") in ("pending", "running"):
+            return
+        completed = [
+            signal_name
+            for signal_name in input_signal.v_model
+            if signal_name not in signals_completed
+            and not graph.group_incomplete(signal_name)
+            and not any(
+                graph.status(name) in ("pending", "running")
+                for name in graph.group_tasks(signal_name)
+            )
+        ]
+        if not completed:
+            return
+        signals_completed.extend(completed)
+        success.children = [
+            f"{len(signals_completed)} of {len(input_signal.v_model)} signals completed. Created {created_string} for {', '.join(signals_completed)}."
+        ]
+        success.value = True
+
+    # ready artifacts of all signals run concurrently on a bounded thread pool
+    try:
+        graph.run(max_workers, signal_progress, cancel_event)
+    except RunCancelled as cancelled:
+        # a cancelled run is registered with what it already pushed, so a later cleanup archives it.
+        # It completed no signal, so it supersedes nothing
+        try:
+            register_run(
+                workbook_id, run_id, graph, input_signal.v_model, [], worksheet_ids
+            )
+        except Exception as e:
+            raise RunCancelled(f"Run registry failed: {e}") from cancelled
+        raise
+
+    failed_signals = {}
     for signal_name in input_signal.v_model:
-        # Create and push average and standard deviation formulas
-        average_formula_string = create_mean_formula_string(
-            capsule_start,
-            capsule_end,
-            input_condition,
-            capsule_property,
-            conditions,
-            start_select,
-            end_select,
+        if graph.group_incomplete(signal_name) or graph.group_incomplete(None):
+            errors = graph.group_errors(signal_name) + graph.group_errors(None)
+            failed_signals[signal_name] = errors[0] if errors else "not completed"
+    completed_signals = [
+        signal_name
+        for signal_name in input_signal.v_model
+        if signal_name not in failed_signals
+    ]
+    num_completed = len(completed_signals)
+    failed_string = "".join(
+        f" Failed for {signal_name}: {message}."
+        for signal_name, message in failed_signals.items()
+    )
+    failed_string += "".join(
+        f" Formatting failed: {message}."
+        for message in graph.group_errors("Worksheet Template")
+    )
+    incomplete = bool(failed_signals or graph.group_errors("Worksheet Template"))
+    # the run is registered before the cleanup so its own items are never archived, and earlier
+    # runs are only archived when this one completed
+    archived = None
+    try:
+        register_run(
+            workbook_id,
+            run_id,
+            graph,
+            input_signal.v_model,
+            completed_signals,
+            worksheet_ids,
         )
-        stddev_formula_string = create_stddev_formula_string(average_formula_string)
+        if archive_superseded and not incomplete:
+            archived = RunRegistry(workbook_id).archive_superseded()
+    except Exception as e:
+        failed_string += f" Run registry failed: {e}."
+        incomplete = True
+    if incomplete:
+        success.type = "warning"
+
+    display_dict = graph.result("Worksheet Template") or {}
+    pushed_ids = pushed_item_ids(graph)
+    signal_item_ids = {
+        signal_name: {
+            name: pushed_ids[name]
+            for name in graph.group_tasks(signal_name)
+            if name in pushed_ids
+        }
+        for signal_name in completed_signals
+    }
+    for worksheet_name, histogram_id in histogram_dict.items():
+        signal_name = worksheet_name[: -len(" Histogram")]
+        if signal_name in signal_item_ids:
+            signal_item_ids[signal_name][worksheet_name] = histogram_id
+
+    if display_dict:
+        success.children = [
+            f"""{num_completed} of {len(input_signal.v_model)} signals completed. Created {created_string} for {', '.join(completed_signals)}.{failed_string} 
+        Formatting complete. Click link to be taken to the results."""
+        ]
+        workbook_button.disabled = False
+    else:
+        success.children = [
+            f"0 of {len(input_signal.v_model)} signals completed.{failed_string}"
+        ]
+    success.value = True
+
+    button.disabled = False
+    button.loading = False
+
+    generated_items = {
+        "run": run_id,
+        "signals": signal_item_ids,
+        "worksheets": display_dict,
+        "unchanged": unchanged_items,
+        "graph": graph.graph(),
+        "timings": graph.timings(),
+        "archived": archived,
+    }
+    return workbook_button, success, button, generated_items
+
+
+def create_output_string(we_runrules, nelson_runrules, histogram):
+    created_string = "Control Chart"
+    if we_runrules.v_model == True:
+        if (nelson_runrules.v_model == True) or (histogram.v_model == True):
+            created_string += ", Western Electric Run Rules, "
+        else:
+            created_string += " and Western Electric Run Rules"
+    if nelson_runrules.v_model == True:
+        if histogram.v_model == True:
+            created_string += "Nelson Run Rules, "
+        else:
+            created_string += " and Nelson Run Rules"
+    if histogram.v_model == True:
+        created_string += " and Histogram"
+    return created_string
+
+
+def create_run_graph(
+    signal_names,
+    *,
+    capsule_start,
+    capsule_end,
+    input_condition,
+    capsule_property,
+    catalog,
+    start_select,
+    end_select,
+    apply_to_condition,
+    rule_sets,
+    histogram,
+    interp_value,
+    URL,
+    workbook_id,
+    workbook_button,
+    batch_push=False,
+    dry_run=False,
+    property_values=None,
+    min_grade_capsules=1,
+    freeze_limits=False,
+    lean_limits=False,
+    combined_rules=False,
+    scope_rules=False,
+    episode_duration=None,
+    targeted_template=False,
+    summary_worksheets=False,
+    run_id=None,
+):
+    # the options are keyword only, so a new option cannot shift the arguments of the others
+    graph = TaskGraph()
+    histogram_dict = {}
+    unchanged_items = []
+    worksheet_ids = {}
+    has_condition = isinstance(input_condition.v_model, str)
+    with_histogram = histogram.v_model == True
+    has_property = isinstance(capsule_property.v_model, str)
+    # frozen limits need the training window statistics from the server, a plan lists their mean
+    # and standard deviation as computed at run time. With a capsule property every grade is
+    # frozen from the same grouped aggregation
+    frozen = freeze_limits
+    shared_grades = has_property and not frozen
+    limit_names = selected_limits(rule_sets, lean_limits)
+
+    def push_item(item_df):
+        # in batch mode the items are only queued, they reference each other by name and the
+        # Push Items node pushes all of them with a single spy.push call. Otherwise each item is
+        # pushed on its own without a worksheet, concurrent pushes would race on its display items
+        item_df = stamp_content_hash(item_df, capsule_start, capsule_end, run_id)
+        if batch_push or dry_run:
+            return item_df
+        changed_df, unchanged_df = split_unchanged_items(
+            item_df, graph.result("Existing Items") or {}
+        )
+        unchanged_items.extend(unchanged_df["Name"])
+        if changed_df.empty:
+            push_results = unchanged_df
+        else:
+            push_results = push_signals(changed_df, workbook_id)
+        catalog.add(push_results)
+        return push_results
+
+    def mean_stddev_item(
+        signal_name, item_name, formula_strings, grade_conditions_df=None
+    ):
+        if frozen and dry_run:
+            average_formula_string = stddev_formula_string = COMPUTED_AT_RUN_TIME
+        elif frozen:
+            average_formula_string, stddev_formula_string = frozen_formula_strings(
+                signal_name, formula_strings
+            )
+        else:
+            average_formula_string = formula_strings
+            stddev_formula_string = create_stddev_formula_string(formula_strings)
         mean_stddev_signal_df = create_mean_and_stddev_signals(
             average_formula_string,
             stddev_formula_string,
             signal_name,
             input_condition,
-            signals,
-            conditions,
+            catalog,
             apply_to_condition,
+            (
+                grade_formula_parameters(grade_conditions_df)
+                if grade_conditions_df is not None
+                else None
+            ),
         )
-        mean_stddev_push_df = push_signals(
-            mean_stddev_signal_df, workbook_id, f"{signal_name} Control Chart"
-        )
-
-        # Create and push 1, 2, and 3 sigma limits
-        limits_df = create_limit_signals(mean_stddev_push_df, signal_name)
-        limits_push_df = push_signals(
-            limits_df, workbook_id, f"{signal_name} Control Chart"
-        )
-        created_string = "Control Chart"
-        control_chart_signal_list = [
-            mean_stddev_push_df[
-                mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-            ].ID.iloc[0]
-        ]
-        control_chart_signal_list += limits_push_df.ID.to_list()
-        control_chart_signal_list += [
-            signals[signals["Name"] == signal_name].ID.iloc[0]
-        ]
-        if isinstance(input_condition.v_model, str):
-            control_chart_signal_list += [
-                conditions[conditions["Name"] == apply_to_condition.v_model].ID.iloc[0]
-            ]
-        display_dict[f"{signal_name} Control Chart"] = control_chart_signal_list
+        return push_item(select_item(mean_stddev_signal_df, item_name))
 
-        # Create Western Electric Run Rules
-        if we_runrules.v_model == True:
-            western_electric_rules_df = western_electric_df(
-                limits_push_df, mean_stddev_push_df, signal_name, interp_value, signals
+    def grade_conditions():
+        unique_properties = (
+            list(property_values)
+            if property_values is not None
+            else capsule_properties.values(
+                catalog.item(input_condition.v_model),
+                capsule_property.v_model,
+                start_select.value,
+                end_select.value,
+                min_grade_capsules,
             )
-            western_electric_push_df = push_signals(
-                western_electric_rules_df,
-                workbook_id,
-                f"{signal_name} Western Electric Run Rules",
+        )
+        grade_conditions_df, formula_variables = create_grade_conditions(
+            unique_properties,
+            capsule_property,
+            input_condition,
+            apply_to_condition,
+            catalog,
+        )
+        grade_conditions_df = stamp_content_hash(
+            grade_conditions_df, capsule_start, capsule_end, run_id
+        )
+        if not dry_run and not grade_conditions_df.empty:
+            changed_df, unchanged_df = split_unchanged_items(
+                grade_conditions_df, graph.result("Existing Items") or {}
             )
-            if (nelson_runrules.v_model == True) or (histogram.v_model == True):
-                created_string += ", Western Electric Run Rules, "
-            else:
-                created_string += " and Western Electric Run Rules"
-            western_electric_signal_list = control_chart_signal_list.copy()
-            western_electric_signal_list += western_electric_push_df.ID.to_list()
-            display_dict[f"{signal_name} Western Electric Run Rules"] = (
-                western_electric_signal_list
+            unchanged_items.extend(unchanged_df["Name"])
+            if not changed_df.empty:
+                changed_df = push_signals(changed_df, workbook_id)
+            # the push keeps the row order, the formula variables are matched by position
+            grade_conditions_df = (
+                pd.concat([changed_df, unchanged_df])
+                .set_index("Name", drop=False)
+                .loc[grade_conditions_df["Name"]]
+                .reset_index(drop=True)
             )
+            catalog.add(grade_conditions_df)
+        grade_conditions_df.attrs["Formula Variables"] = formula_variables
+        return grade_conditions_df
 
-        # Create Nelson Run Rules
-        if nelson_runrules.v_model == True:
-            nelson_rules_df = nelson_df(
-                limits_push_df, mean_stddev_push_df, signal_name, interp_value, signals
+    def frozen_formula_strings(signal_name, statistics):
+        if signal_name not in statistics:
+            raise ValueError("no samples in the training window")
+        units = catalog.units(signal_name)
+        if not has_property:
+            return create_frozen_formula_strings(
+                *statistics[signal_name], has_condition, units
             )
-            nelson_push_df = push_signals(
-                nelson_rules_df, workbook_id, f"{signal_name} Nelson Run Rules"
+        statistics = statistics[signal_name]
+        if property_values is not None or min_grade_capsules > 1:
+            grades = property_values or capsule_properties.values(
+                catalog.item(input_condition.v_model),
+                capsule_property.v_model,
+                start_select.value,
+                end_select.value,
+                min_grade_capsules,
             )
-            if histogram.v_model == True:
-                created_string += "Nelson Run Rules, "
-            else:
-                created_string += " and Nelson Run Rules"
-            nelson_signal_list = control_chart_signal_list.copy()
-            nelson_signal_list += nelson_push_df.ID.to_list()
-            display_dict[f"{signal_name} Nelson Run Rules"] = nelson_signal_list
-        if num_completed == 0:
-            signals_completed += signal_name
+            statistics = {
+                grade: grade_stats
+                for grade, grade_stats in statistics.items()
+                if grade in grades
+            }
+        return create_grouped_formula_strings(statistics, capsule_property, units)
+
+    def statistics_item():
+        if dry_run:
+            return None
+        return training_statistics(
+            {signal_name: catalog.id(signal_name) for signal_name in signal_names},
+            catalog.id(input_condition.v_model) if has_condition else None,
+            catalog.id(apply_to_condition.v_model) if has_condition else None,
+            capsule_property.v_model if has_property else None,
+            capsule_start,
+            capsule_end,
+        )
+
+    def limit_item(signal_name, item_name, mean_df, stddev_df):
+        limits_df = create_limit_signals(pd.concat([mean_df, stddev_df]), signal_name)
+        return push_item(select_item(limits_df, item_name))
+
+    def rule_item(rules_function, rules_name, signal_name, item_name, *limit_dfs):
+        limits_df = (
+            pd.concat(limit_dfs) if limit_dfs else pd.DataFrame(columns=["Name"])
+        )
+        rules_df = rules_function(
+            limits_df,
+            limits_df,
+            signal_name,
+            interp_value,
+            catalog,
+            apply_to_condition if scope_rules and has_condition else None,
+        )
+        rule_df = select_item(rules_df, item_name)
+        if episode_duration is not None:
+            rule_df = rule_episodes(rule_df, rules_name, episode_duration)
+        return push_item(rule_df)
+
+    def within_item(signal_name):
+        within_signal_df = within_condition_signal_df(
+            signal_name, input_condition, catalog
+        )
+        return push_item(within_signal_df)
+
+    def push_items():
+        # items of a signal with a failed item are left out so no partial chart is pushed
+        item_set = set(item_names)
+        item_dfs = [
+            graph.result(name)
+            for name in item_names
+            if graph.status(name) == "done"
+            and not graph.group_incomplete(graph.tasks[name]["group"], item_set)
+        ]
+        item_tasks = {
+            item_name: name
+            for name in item_names
+            if graph.status(name) == "done"
+            for item_name in graph.result(name)["Name"]
+        }
+        if not item_dfs:
+            return pd.DataFrame(columns=["Name", "ID"])
+        changed_df, unchanged_df = split_unchanged_items(
+            pd.concat(item_dfs, ignore_index=True),
+            graph.result("Existing Items") or {},
+        )
+        unchanged_items.extend(unchanged_df["Name"])
+        if changed_df.empty:
+            push_results = unchanged_df
         else:
-            signals_completed += ", " + signal_name
+            pushed_df = push_signals(changed_df, workbook_id, errors="catalog")
+            # an item the server rejects only fails the node of that item, so only its signal is
+            # reported as failed and the items of the other signals are kept
+            failed = failed_pushes(pushed_df)
+            for item_name, message in zip(
+                pushed_df.loc[failed, "Name"], pushed_df.loc[failed, "Push Result"]
+            ):
+                graph.fail(item_tasks[item_name], f"Push failed: {message}")
+            push_results = pd.concat(
+                [pushed_df[~failed], unchanged_df], ignore_index=True
+            )
+        catalog.add(push_results)
+        return push_results
 
-        # Create Histogram for Normality Test
-        if histogram.v_model == True:
-            if isinstance(input_condition.v_model, str):
-                within_signal_df = within_condition_signal_df(
-                    signal_name, input_condition, signals, conditions
+    def histogram_items():
+        # the histograms of all signals are created together, a histogram whose hash is
+        # unchanged is reused and signals whose within condition was not pushed are left out
+        existing_items = graph.result("Existing Items") or {}
+        histogram_ids = {}
+        signal_dfs = {}
+        histogram_hashes = {}
+        for signal_name in signal_names:
+            if has_condition:
+                within_name = f"{signal_name}: Within Condition"
+                source_df = (
+                    graph.result("Push Items")
+                    if batch_push
+                    else graph.result(within_name)
                 )
-                within_signal_push_df = push_signals(
-                    within_signal_df, workbook_id, f"{signal_name} Histogram"
+                if graph.status(within_name) != "done" or source_df is None:
+                    continue
+                histogram_signal_df = select_item(source_df, within_name)
+                if histogram_signal_df.empty:
+                    continue
+            else:
+                histogram_signal_df = catalog.item(signal_name)
+            histogram_hash = content_hash(
+                {
+                    "Name": f"{signal_name} Histogram",
+                    "Type": "Chart",
+                    "Formula": capsule_property.v_model,
+                    "Formula Parameters": {
+                        "$signal": histogram_signal_df,
+                        "$condition": catalog.item(input_condition.v_model),
+                    },
+                },
+                start_select.value.isoformat(),
+                end_select.value.isoformat(),
+            )
+            if (f"{signal_name} Histogram", histogram_hash) in existing_items:
+                unchanged_items.append(f"{signal_name} Histogram")
+                histogram_ids[signal_name] = existing_items[
+                    (f"{signal_name} Histogram", histogram_hash)
+                ]
+            else:
+                signal_dfs[signal_name] = histogram_signal_df
+                histogram_hashes[signal_name] = histogram_hash
+        histogram_ids.update(
+            create_histograms(
+                signal_dfs,
+                histogram_hashes,
+                start_select.value.isoformat(),
+                end_select.value.isoformat(),
+                input_condition,
+                catalog,
+                workbook_id,
+                capsule_property,
+                run_id,
+            )
+        )
+        return histogram_ids
+
+    def histogram_item(signal_name, histogram_ids):
+        histogram_id = histogram_ids.get(signal_name)
+        if histogram_id is None:
+            raise ValueError(f"The within condition of '{signal_name}' was not pushed")
+        if isinstance(histogram_id, Exception):
+            raise histogram_id
+        return histogram_id
+
+    def worksheet_template():
+        # a plan lists the items of each worksheet by name since none of them have an ID yet
+        item_ids = (
+            {name: name for name in item_names if graph.status(name) == "done"}
+            if dry_run
+            else pushed_item_ids(graph)
+        )
+        worksheets = signal_worksheets(
+            item_ids,
+            signal_names,
+            limit_names,
+            catalog,
+            input_condition,
+            apply_to_condition,
+            rule_sets,
+            combined_rules,
+        )
+        display_dict = (
+            summary_layout(worksheets)
+            if summary_worksheets
+            else {
+                worksheet_name: worksheet_item_ids
+                for signal_sheets in worksheets.values()
+                for worksheet_name, worksheet_item_ids in signal_sheets.items()
+            }
+        )
+        if dry_run:
+            if with_histogram:
+                # histograms are built from the data, a plan only lists their worksheets
+                display_dict.update(
+                    {
+                        worksheet_name: [name for name, _ in histograms]
+                        for worksheet_name, histograms in histogram_worksheets(
+                            {
+                                f"{signal_name} Histogram": f"{signal_name} Histogram"
+                                for signal_name in signal_names
+                                if signal_name in worksheets
+                            },
+                            summary_worksheets,
+                        ).items()
+                    }
                 )
-                histogram_id = create_histogram(
-                    within_signal_push_df,
-                    start_select.value.isoformat(),
-                    end_select.value.isoformat(),
-                    input_condition,
-                    conditions,
-                    workbook_id,
-                    capsule_property,
+            return display_dict
+        # histogram worksheets are created in the same workbook pull and push as the others
+        for signal_name in signal_names:
+            if graph.status(f"{signal_name} Histogram") == "done":
+                histogram_dict[f"{signal_name} Histogram"] = graph.result(
+                    f"{signal_name} Histogram"
                 )
-            else:
-                histogram_id = create_histogram(
-                    signals[signals["Name"] == signal_name],
-                    start_select.value.isoformat(),
-                    end_select.value.isoformat(),
-                    input_condition,
-                    conditions,
-                    workbook_id,
-                    capsule_property,
+        if not display_dict and not histogram_dict:
+            return {}
+        worksheet_ids.update(
+            create_template(
+                URL,
+                display_dict,
+                histogram,
+                input_condition,
+                start_select,
+                end_select,
+                workbook_button,
+                workbook_id,
+                histogram_dict,
+                catalog,
+                targeted_template,
+                summary_worksheets,
+            )
+        )
+        display_dict.update(
+            {
+                worksheet_name: [histogram_id for _, histogram_id in histograms]
+                for worksheet_name, histograms in histogram_worksheets(
+                    histogram_dict, summary_worksheets
+                ).items()
+            }
+        )
+        return display_dict
+
+    # hashes of the items already in the workbook are looked up once, items are only pushed when
+    # their hash changed. When the lookup fails every item is pushed, so it is not a signal failure
+    graph.add(
+        "Existing Items",
+        functools.partial(existing_item_hashes, workbook_id),
+        group="Existing Items",
+        enabled=not dry_run,
+    )
+    # the per grade conditions are the same for every signal, so they are created once per run
+    graph.add(
+        "Grade Conditions",
+        grade_conditions,
+        after=["Existing Items"],
+        enabled=shared_grades,
+    )
+    graph.add(
+        "Mean Formula",
+        lambda: create_mean_formula_string(
+            capsule_start,
+            capsule_end,
+            input_condition,
+            capsule_property,
+            catalog,
+            start_select,
+            end_select,
+            property_values,
+            min_grade_capsules,
+        ),
+        after=["Grade Conditions"],
+        enabled=not frozen,
+    )
+    # frozen limits of all signals and grades come from one aggregation over the training window
+    graph.add("Training Statistics", statistics_item, enabled=frozen)
+    item_names = []
+    for signal_name in signal_names:
+        mean_name = f"{signal_name}: Mean"
+        stddev_name = f"{signal_name}: Standard Deviation"
+        for item_name in [mean_name, stddev_name]:
+            graph.add(
+                item_name,
+                functools.partial(mean_stddev_item, signal_name, item_name),
+                (
+                    ["Training Statistics"]
+                    if frozen
+                    else ["Mean Formula"]
+                    + (["Grade Conditions"] if shared_grades else [])
+                ),
+                after=["Existing Items"],
+                group=signal_name,
+            )
+        for limit in limit_names:
+            graph.add(
+                f"{signal_name}: {limit}",
+                functools.partial(limit_item, signal_name, f"{signal_name}: {limit}"),
+                [mean_name, stddev_name],
+                after=["Existing Items"],
+                group=signal_name,
+            )
+        for rules_name, rules_function, rule_limits in rule_sets:
+            for item_name, (item_function, limits) in rule_items(
+                signal_name, rules_name, rules_function, rule_limits, combined_rules
+            ).items():
+                graph.add(
+                    item_name,
+                    functools.partial(
+                        rule_item,
+                        item_function,
+                        rules_name,
+                        signal_name,
+                        item_name,
+                    ),
+                    [f"{signal_name}: {limit}" for limit in limits],
+                    after=["Existing Items"],
+                    group=signal_name,
                 )
-            format_histogram_worksheet(histogram_id, signal_name, URL, workbook_id)
-            histogram_dict[f"{signal_name} Histogram"] = histogram_id
-            created_string += " and Histogram"
-        num_completed += 1
-        success.children = [
-            f"{num_completed} of {len(input_signal.v_model)} signals completed. Created {created_string} for {signals_completed}."
-        ]
-        success.value = True
+        graph.add(
+            f"{signal_name}: Within Condition",
+            functools.partial(within_item, signal_name),
+            after=["Existing Items"],
+            group=signal_name,
+            enabled=with_histogram and has_condition,
+        )
+        item_names += graph.group_tasks(signal_name)
 
-    # Edit the worksheet(s) display(s) to specify formatting
-    success.children = [
-        f"{num_completed} of {len(input_signal.v_model)} signals completed. Created {created_string} for {signal_name}. Formatting worksheets..."
-    ]
+    if batch_push:
+        graph.add("Push Items", push_items, after=item_names, enabled=not dry_run)
 
-    worksheet_data_dict = create_template(
-        URL,
-        display_dict,
-        histogram,
-        input_condition,
-        start_select,
-        end_select,
-        workbook_button,
-        workbook_id,
-        histogram_dict,
+    # the histograms are built from the pushed within conditions, their worksheets are created
+    # by the worksheet template
+    graph.add(
+        "Histograms",
+        histogram_items,
+        after=["Existing Items"]
+        + [f"{signal_name}: Within Condition" for signal_name in signal_names]
+        + (["Push Items"] if batch_push else []),
+        enabled=with_histogram and not dry_run,
     )
+    for signal_name in signal_names:
+        graph.add(
+            f"{signal_name} Histogram",
+            functools.partial(histogram_item, signal_name),
+            ["Histograms"],
+            group=signal_name,
+            enabled=with_histogram and not dry_run,
+        )
 
-    success.children = [
-        f"""{num_completed} of {len(input_signal.v_model)} signals completed. Created {created_string} for {signal_name}. 
-        Formatting complete. Click link to be taken to the results."""
+    graph.add(
+        "Worksheet Template",
+        worksheet_template,
+        after=list(graph.tasks),
+        group="Worksheet Template",
+    )
+    return graph, histogram_dict, unchanged_items, worksheet_ids
+
+
+def run_plan(graph):
+    items = []
+    for name, task in graph.tasks.items():
+        if task["status"] == "done" and isinstance(task["result"], pd.DataFrame):
+            for _, item in task["result"].iterrows():
+                items.append(
+                    {
+                        "Name": item["Name"],
+                        "Type": item["Type"],
+                        "Formula": item["Formula"],
+                        "Formula Parameters": {
+                            parameter_name: parameter_reference(parameter)
+                            for parameter_name, parameter in item[
+                                "Formula Parameters"
+                            ].items()
+                        },
+                        # the hash of a frozen item depends on constants the plan does not have
+                        CONTENT_HASH_PROPERTY: (
+                            None
+                            if item["Formula"] == COMPUTED_AT_RUN_TIME
+                            else item[CONTENT_HASH_PROPERTY]
+                        ),
+                    }
+                )
+    return {
+        "items": items,
+        "worksheets": graph.result("Worksheet Template") or {},
+        "errors": {
+            name: task["error"]
+            for name, task in graph.tasks.items()
+            if task["status"] == "failed"
+        },
+        "graph": graph.graph(),
+        "timings": graph.timings(),
+    }
+
+
+def selected_rule_sets(we_runrules, nelson_runrules, we_rules, nelson_rules):
+    # the checked rule sets with the limit lines of the rules picked for each, a rule set
+    # without picked rules creates nothing
+    rule_sets = []
+    for rules_name, rules_function, runrules, rules in [
+        ("Western Electric", western_electric_df, we_runrules, we_rules),
+        ("Nelson", nelson_df, nelson_runrules, nelson_rules),
+    ]:
+        rule_limits = {
+            rule: limits
+            for rule, limits in RULE_LIMITS[rules_name].items()
+            if rule in rules.v_model
+        }
+        if runrules.v_model == True and rule_limits:
+            rule_sets.append((rules_name, rules_function, rule_limits))
+    return rule_sets
+
+
+def selected_limits(rule_sets, lean_limits):
+    # the lean output keeps the +/-3 sigma control limits and the lines the selected rules use
+    if not lean_limits:
+        return LIMIT_NAMES
+    limits = {"+3 Sigma", "-3 Sigma"}
+    for _, _, rule_limits in rule_sets:
+        for rule_limit_names in rule_limits.values():
+            limits.update(rule_limit_names)
+    return [limit for limit in LIMIT_NAMES if limit in limits]
+
+
+def rule_items(signal_name, rules_name, rules_function, rule_limits, combined_rules):
+    # the combined mode pushes one condition per rule set that depends on the lines of all its
+    # rules, the Rule capsule property tells the rules apart. AllRules evaluates every rule of
+    # the set, so a partial selection keeps one condition per picked rule
+    if combined_rules and rule_limits.keys() == RULE_LIMITS[rules_name].keys():
+        return {
+            f"{signal_name}: {rules_name} Run Rules": (
+                functools.partial(combined_rules_df, rules_name),
+                list(
+                    dict.fromkeys(
+                        limit for limits in rule_limits.values() for limit in limits
+                    )
+                ),
+            )
+        }
+    return {
+        f"{signal_name}: {rules_name} Run Rule {rule}": (rules_function, limits)
+        for rule, limits in rule_limits.items()
+    }
+
+
+def select_item(items_df, item_name):
+    return items_df[items_df["Name"] == item_name].reset_index(drop=True)
+
+
+def register_run(
+    workbook_id, run_id, graph, signal_names, completed_signals, worksheet_ids
+):
+    # histograms are read from their node since a cancelled run never gets to the template
+    item_ids = list(pushed_item_ids(graph).values()) + [
+        histogram_id
+        for histogram_id in (graph.result("Histograms") or {}).values()
+        if isinstance(histogram_id, str)
     ]
+    if not item_ids and not worksheet_ids:
+        return
+    RunRegistry(workbook_id).register(
+        run_id, item_ids, worksheet_ids.values(), signal_names, completed_signals
+    )
+
+
+def pushed_item_ids(graph):
+    # per item push results in the default mode, a single Push Items result in batch mode
+    pushed_ids = {}
+    for name, task in graph.tasks.items():
+        result = task["result"]
+        if (
+            task["status"] == "done"
+            and isinstance(result, pd.DataFrame)
+            and "ID" in result.columns
+        ):
+            pushed_ids.update(zip(result["Name"], result["ID"]))
+    return pushed_ids
 
-    workbook_button.disabled = False
-    button.disabled = False
-    button.loading = False
 
-    return workbook_button, success, button
+def signal_worksheets(
+    item_ids,
+    signal_names,
+    limit_names,
+    catalog,
+    input_condition,
+    apply_to_condition,
+    rule_sets,
+    combined_rules=False,
+):
+    worksheets = {}
+    for signal_name in signal_names:
+        # signals missing a pushed item get no worksheets, the layout expects every limit line
+        required_items = [f"{signal_name}: Mean"]
+        required_items += [f"{signal_name}: {limit}" for limit in limit_names]
+        for rules_name, _, rule_limits in rule_sets:
+            required_items += list(
+                rule_items(signal_name, rules_name, None, rule_limits, combined_rules)
+            )
+        if any(item not in item_ids for item in required_items):
+            continue
+        control_chart_signal_list = [item_ids[f"{signal_name}: Mean"]]
+        control_chart_signal_list += [
+            item_ids[f"{signal_name}: {limit}"] for limit in limit_names
+        ]
+        control_chart_signal_list += [catalog.id(signal_name)]
+        if isinstance(input_condition.v_model, str):
+            control_chart_signal_list += [catalog.id(apply_to_condition.v_model)]
+        worksheets[signal_name] = {
+            f"{signal_name} Control Chart": control_chart_signal_list
+        }
+        for rules_name, _, rule_limits in rule_sets:
+            worksheets[signal_name][f"{signal_name} {rules_name} Run Rules"] = (
+                control_chart_signal_list
+                + [
+                    item_ids[item_name]
+                    for item_name in rule_items(
+                        signal_name, rules_name, None, rule_limits, combined_rules
+                    )
+                ]
+            )
+    return worksheets
+
+
+def summary_layout(worksheets):
+    # the summary layout puts the chart and rules of SUMMARY_SIGNALS signals on one worksheet,
+    # every rule worksheet of a signal already holds its control chart items
+    signal_names = list(worksheets)
+    return {
+        f"SPC Summary {i // SUMMARY_SIGNALS + 1}": list(
+            dict.fromkeys(
+                item_id
+                for signal_name in signal_names[i : i + SUMMARY_SIGNALS]
+                for item_ids in worksheets[signal_name].values()
+                for item_id in item_ids
+            )
+        )
+        for i in range(0, len(signal_names), SUMMARY_SIGNALS)
+    }
 
 
 def set_apply_to_condition(apply_to_condition, input_condition):
@@ -252,39 +1054,35 @@ def create_mean_formula_string(
     capsule_end,
     input_condition,
     capsule_property,
-    conditions,
+    catalog,
     start_select,
     end_select,
+    property_values=None,
+    min_capsules=1,
 ):
     if isinstance(capsule_property.v_model, str):
-        capsules = spy.pull(
-            conditions[conditions["Name"] == input_condition.v_model],
-            start=start_select.value,
-            end=end_select.value,
-            quiet=True,
-        )
-        unique_properties = capsules[capsule_property.v_model].unique().tolist()
+        if property_values is None:
+            unique_properties = capsule_properties.values(
+                catalog.item(input_condition.v_model),
+                capsule_property.v_model,
+                start_select.value,
+                end_select.value,
+                min_capsules,
+            )
+        else:
+            unique_properties = list(property_values)
         capsule_string = f"//Define the time period that contains all in control capsules\n$capsule = capsule('{capsule_start}', '{capsule_end}')"
-        in_control_string = "\n \n//Narrow down data to when process is in control, use keep() to filter the condition by the specific grade code capsule property\n"
-        unweighted_average_string = "\n \n//Create average based on the times the product is in control, use .toDiscrete to create an unweighted average\n"
-        output_string = "\n \n//Create average for all grades in one signal using splice(), use keep() to filter the condition by the specific grade code capsule property\n//use within() to show only average only during the condition\n0"
+        unweighted_average_string = "\n \n//Create average based on the times the product is in control, use .toDiscrete to create an unweighted average\n//the in control condition of each grade (${grade}) and its apply to condition (${grade}_applyto) are shared condition items\n"
+        output_string = "\n \n//Create average for all grades in one signal using splice()\n//use within() to show only average only during the condition\n0"
         # iterate through each unique property value to add to the average formula
-        for prop in unique_properties:
-            if isinstance(prop, str) and prop and prop[0].isalpha():
-                property_text = re.sub(r"\W+", "", prop)
-                prop_match = "'" + prop + "'"
-            else:
-                property_text = "a" + re.sub(r"\W+", "", str(prop))
-                prop_match = prop
-            in_control_string += f"${property_text} = $applytocondition.keep('{capsule_property.v_model}', isMatch({prop_match})).intersect($inputcondition)\n"
+        for prop, property_text, prop_match in grade_variables(unique_properties):
             unweighted_average_string += f"${property_text}_average = $inputsignal.remove(not ${property_text}).toDiscrete().average($capsule)\n"
-            output_string += f".splice(${property_text}_average, $applytocondition.keep('{capsule_property.v_model}', isMatch({prop_match})))\n"
+            output_string += (
+                f".splice(${property_text}_average, ${property_text}_applyto)\n"
+            )
         output_string += ".within($applytocondition)"
         average_formula_string = (
-            capsule_string
-            + in_control_string
-            + unweighted_average_string
-            + output_string
+            capsule_string + unweighted_average_string + output_string
         )
     elif isinstance(input_condition.v_model, str):
         capsule_string = f"//Define the time period that contains all in control capsules\n$capsule = capsule('{capsule_start}', '{capsule_end}')"
@@ -305,27 +1103,319 @@ def create_mean_formula_string(
     return average_formula_string
 
 
+def training_statistics(
+    signal_ids,
+    input_condition_id,
+    apply_to_condition_id,
+    property_name,
+    capsule_start,
+    capsule_end,
+):
+    # mean and standard deviation of every signal, and of every grade with a capsule property,
+    # from a single formula run over the training window
+    parameters = [
+        f"signal{i}={signal_id}" for i, signal_id in enumerate(signal_ids.values())
+    ]
+    if input_condition_id is not None:
+        parameters += [
+            f"inputcondition={input_condition_id}",
+            f"applytocondition={apply_to_condition_id}",
+        ]
+        in_control = ".remove(not $applytocondition.intersect($inputcondition))"
+    else:
+        in_control = ""
+    if property_name is not None:
+        formula = (
+            "conditionTable($applytocondition.intersect($inputcondition)"
+            f".toGroup(capsule('{capsule_start}', '{capsule_end}'), CapsuleBoundary.Intersect), '{property_name}')"
+        )
+        for i in range(len(signal_ids)):
+            formula += (
+                f".addStatColumn('signal{i} Mean', $signal{i}.toDiscrete(), average())"
+                f".addStatColumn('signal{i} StdDev', $signal{i}.toDiscrete(), stdDev())"
+            )
+    else:
+        window_seconds = math.ceil(
+            (pd.Timestamp(capsule_end) - pd.Timestamp(capsule_start)).total_seconds()
+        )
+        formula = f"condition({window_seconds + 1}s, capsule('{capsule_start}', '{capsule_end}'))"
+        for i in range(len(signal_ids)):
+            formula += (
+                f".setProperty('signal{i} Mean', $signal{i}{in_control}.toDiscrete(), average())"
+                f".setProperty('signal{i} StdDev', $signal{i}{in_control}.toDiscrete(), stdDev())"
+            )
+    output = formulaAPI.run_formula(
+        start=capsule_start, end=capsule_end, formula=formula, parameters=parameters
+    )
+    if property_name is not None:
+        # every statistic has its own named column, a missing column is an error rather than
+        # grades that are silently left out
+        headers = [header.name for header in output.table.headers]
+        missing = [
+            column
+            for i in range(len(signal_ids))
+            for column in [f"signal{i} Mean", f"signal{i} StdDev"]
+            if column not in headers
+        ] + ([property_name] if property_name not in headers else [])
+        if missing:
+            raise ValueError(
+                f"Training statistics are missing the columns {', '.join(missing)}"
+            )
+        rows = [dict(zip(headers, row)) for row in output.table.data]
+    else:
+        rows = [
+            {prop.name: prop.value for prop in capsule.properties}
+            for capsule in output.capsules.capsules
+        ]
+    statistics = {}
+    for i, signal_name in enumerate(signal_ids):
+        for row in rows:
+            # a signal or grade without samples, or with a single one, has no limits and is left
+            # out like grades below the minimum capsule count
+            mean = finite_statistic(row.get(f"signal{i} Mean"))
+            stddev = finite_statistic(row.get(f"signal{i} StdDev"))
+            if mean is None or stddev is None:
+                continue
+            if property_name is not None:
+                if row[property_name] is not None:
+                    statistics.setdefault(signal_name, {})[row[property_name]] = (
+                        mean,
+                        stddev,
+                    )
+            else:
+                statistics[signal_name] = (mean, stddev)
+    return statistics
+
+
+def finite_statistic(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def units_formula(units):
+    # constants are unitless, the frozen limits get the units of the signal they were computed from
+    if not isinstance(units, str) or not units or units == "string":
+        return ""
+    return ".setUnits('" + units.replace("'", "\\'") + "')"
+
+
+def create_frozen_formula_strings(mean, stddev, has_condition, units=None):
+    if finite_statistic(mean) is None or finite_statistic(stddev) is None:
+        raise ValueError("no finite mean and standard deviation in the training window")
+    average_formula_string = f"//Training window average, computed once when the limits were frozen\n{mean}.toSignal(){units_formula(units)}"
+    stddev_formula_string = f"//Training window standard deviation, computed once when the limits were frozen\n{stddev}.toSignal(){units_formula(units)}"
+    if has_condition:
+        average_formula_string += ".within($applytocondition)"
+        stddev_formula_string += ".within($applytocondition)"
+    return average_formula_string, stddev_formula_string
+
+
+def create_grouped_formula_strings(statistics, capsule_property, units=None):
+    # the statistics of every grade come from one aggregation, but the formulas still have one
+    # splice line per grade. Seeq formulas have no lookup from a property value to a number, so
+    # the formula size is not flat in the number of grades
+    average_formula_string = "//Training window average of each grade, computed once and applied with splice()\n0"
+    stddev_formula_string = "//Training window standard deviation of each grade, computed once and applied with splice()\n0"
+    statistics = {
+        prop: (mean, stddev)
+        for prop, (mean, stddev) in statistics.items()
+        if finite_statistic(mean) is not None and finite_statistic(stddev) is not None
+    }
+    if not statistics:
+        raise ValueError("no grade has a finite mean and standard deviation")
+    for prop, property_text, prop_match in grade_variables(statistics):
+        mean, stddev = statistics[prop]
+        grade_condition = f"$applytocondition.keep('{capsule_property.v_model}', isMatch({prop_match}))"
+        average_formula_string += f".splice({mean}, {grade_condition})\n"
+        stddev_formula_string += f".splice({stddev}, {grade_condition})\n"
+    average_formula_string += units_formula(units) + ".within($applytocondition)"
+    stddev_formula_string += units_formula(units) + ".within($applytocondition)"
+    return average_formula_string, stddev_formula_string
+
+
+def grade_variables(unique_properties):
+    # formula variable and isMatch() argument of every grade
+    variables = []
+    for prop in unique_properties:
+        if isinstance(prop, str) and prop and prop[0].isalpha():
+            property_text = re.sub(r"\W+", "", prop)
+            prop_match = "'" + prop + "'"
+        else:
+            property_text = "a" + re.sub(r"\W+", "", str(prop))
+            prop_match = prop
+        variables.append((prop, property_text, prop_match))
+    return variables
+
+
+def create_grade_conditions(
+    unique_properties, capsule_property, input_condition, apply_to_condition, catalog
+):
+    # created once per run and referenced by the mean and stddev of every signal. The in control
+    # condition is named after the input condition too, a run with another input condition must
+    # not replace the one the limits of an earlier run reference
+    grade_conditions = []
+    formula_variables = []
+    for prop, property_text, prop_match in grade_variables(unique_properties):
+        grade_conditions += [
+            {
+                "Name": f"{apply_to_condition.v_model}: {capsule_property.v_model} {prop} In Control ({input_condition.v_model})",
+                "Type": "Condition",
+                "Formula": f"$applytocondition.keep('{capsule_property.v_model}', isMatch({prop_match})).intersect($inputcondition)",
+                "Formula Parameters": {
+                    "$applytocondition": catalog.item(apply_to_condition.v_model),
+                    "$inputcondition": catalog.item(input_condition.v_model),
+                },
+            },
+            {
+                "Name": f"{apply_to_condition.v_model}: {capsule_property.v_model} {prop}",
+                "Type": "Condition",
+                "Formula": f"$applytocondition.keep('{capsule_property.v_model}', isMatch({prop_match}))",
+                "Formula Parameters": {
+                    "$applytocondition": catalog.item(apply_to_condition.v_model)
+                },
+            },
+        ]
+        formula_variables += [f"${property_text}", f"${property_text}_applyto"]
+    grade_conditions_df = pd.DataFrame(
+        grade_conditions, columns=["Name", "Type", "Formula", "Formula Parameters"]
+    )
+    return grade_conditions_df, formula_variables
+
+
+def grade_formula_parameters(grade_conditions_df):
+    return {
+        variable: grade_conditions_df.iloc[[i]]
+        for i, variable in enumerate(grade_conditions_df.attrs["Formula Variables"])
+    }
+
+
 def create_stddev_formula_string(average_formula_string):
     # standard deviation formula is the same as average formula, just replacing average with stddev
     stddev_formula_string = re.sub("average", "stddev", average_formula_string)
     return stddev_formula_string
 
 
-def push_signals(push_df, workbook_id, worksheet_name):
+def parameter_reference(parameter):
+    if isinstance(parameter, pd.DataFrame):
+        if parameter.empty:
+            return None
+        if CONTENT_HASH_PROPERTY in parameter.columns:
+            # generated items are identified by name within the workbook whether or not they are
+            # pushed yet, their own hash covers their content
+            return parameter[["Name", "Type"]].iloc[0].to_list()
+        return parameter["ID"].iloc[0]
+    return parameter
+
+
+def content_hash(item, capsule_start, capsule_end):
+    parameters = {
+        parameter_name: parameter_reference(parameter)
+        for parameter_name, parameter in (item.get("Formula Parameters") or {}).items()
+    }
+    content = json.dumps(
+        [
+            item["Name"],
+            item["Type"],
+            item["Formula"],
+            parameters,
+            capsule_start,
+            capsule_end,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def stamp_content_hash(item_df, capsule_start, capsule_end, run_id=None):
+    # the run ID is not part of the hash, an unchanged item keeps the ID of the run that pushed it
+    item_df = item_df.copy()
+    item_df[CONTENT_HASH_PROPERTY] = [
+        content_hash(item, capsule_start, capsule_end) for _, item in item_df.iterrows()
+    ]
+    if run_id is not None:
+        item_df[RUN_ID_PROPERTY] = run_id
+    return item_df
+
+
+def existing_item_hashes(workbook_id):
+    items = spy.search(
+        {"Scoped To": workbook_id},
+        workbook=workbook_id,
+        include_properties=[CONTENT_HASH_PROPERTY],
+        quiet=True,
+    )
+    if items.empty or CONTENT_HASH_PROPERTY not in items.columns:
+        return {}
+    items = items.dropna(subset=[CONTENT_HASH_PROPERTY])
+    return {
+        (name, item_hash): item_id
+        for name, item_hash, item_id in zip(
+            items["Name"], items[CONTENT_HASH_PROPERTY], items["ID"]
+        )
+    }
+
+
+def split_unchanged_items(item_df, existing_items):
+    # unchanged items take the ID of the existing item, references to them from changed items
+    # are replaced by that ID since they are not part of the push
+    item_ids = [
+        existing_items.get((name, item_hash))
+        for name, item_hash in zip(item_df["Name"], item_df[CONTENT_HASH_PROPERTY])
+    ]
+    unchanged = [item_id is not None for item_id in item_ids]
+    unchanged_df = item_df[unchanged].assign(
+        ID=[item_id for item_id in item_ids if item_id is not None]
+    )
+    unchanged_ids = dict(zip(unchanged_df["Name"], unchanged_df["ID"]))
+    changed_df = item_df[[not u for u in unchanged]].copy()
+    changed_df["Formula Parameters"] = [
+        {
+            parameter_name: (
+                unchanged_ids.get(parameter["Name"].iloc[0], parameter)
+                if isinstance(parameter, pd.DataFrame)
+                and not parameter.empty
+                and CONTENT_HASH_PROPERTY in parameter.columns
+                else parameter
+            )
+            for parameter_name, parameter in parameters.items()
+        }
+        for parameters in changed_df["Formula Parameters"]
+    ]
+    return changed_df.reset_index(drop=True), unchanged_df.reset_index(drop=True)
+
+
+def push_signals(push_df, workbook_id, errors="raise"):
+    # worksheets are created and filled by create_template, so nothing is added to a worksheet here.
+    # The batch push catalogs errors per item, see failed_pushes
     push_results = spy.push(
-        metadata=push_df, workbook=workbook_id, worksheet=worksheet_name, quiet=True
+        metadata=push_df,
+        workbook=workbook_id,
+        worksheet=None,
+        errors=errors,
+        quiet=True,
     )
     return push_results
 
 
+def failed_pushes(push_results):
+    # rows of a push with errors="catalog" whose Push Result is an error message
+    if "Push Result" not in push_results.columns:
+        return pd.Series(False, index=push_results.index)
+    return ~push_results["Push Result"].astype(str).str.startswith("Success")
+
+
 def create_mean_and_stddev_signals(
     average_formula_string,
     stddev_formula_string,
     signal_name,
     input_condition,
-    signals,
-    conditions,
+    catalog,
     apply_to_condition,
+    grade_parameters=None,
 ):
     if isinstance(input_condition.v_model, str):
         mean_stddev_signal_df = pd.DataFrame(
@@ -335,13 +1425,9 @@ def create_mean_and_stddev_signals(
                     "Type": "Signal",
                     "Formula": average_formula_string,
                     "Formula Parameters": {
-                        "$inputcondition": conditions[
-                            conditions["Name"] == input_condition.v_model
-                        ],
-                        "$inputsignal": signals[signals["Name"] == signal_name],
-                        "$applytocondition": conditions[
-                            conditions["Name"] == apply_to_condition.v_model
-                        ],
+                        "$inputcondition": catalog.item(input_condition.v_model),
+                        "$inputsignal": catalog.item(signal_name),
+                        "$applytocondition": catalog.item(apply_to_condition.v_model),
                     },
                 },
                 {
@@ -349,13 +1435,9 @@ def create_mean_and_stddev_signals(
                     "Type": "Signal",
                     "Formula": stddev_formula_string,
                     "Formula Parameters": {
-                        "$inputcondition": conditions[
-                            conditions["Name"] == input_condition.v_model
-                        ],
-                        "$inputsignal": signals[signals["Name"] == signal_name],
-                        "$applytocondition": conditions[
-                            conditions["Name"] == apply_to_condition.v_model
-                        ],
+                        "$inputcondition": catalog.item(input_condition.v_model),
+                        "$inputsignal": catalog.item(signal_name),
+                        "$applytocondition": catalog.item(apply_to_condition.v_model),
                     },
                 },
             ]
@@ -367,24 +1449,26 @@ def create_mean_and_stddev_signals(
                     "Name": f"{signal_name}: Mean",
                     "Type": "Signal",
                     "Formula": average_formula_string,
-                    "Formula Parameters": {
-                        "$inputsignal": signals[signals["Name"] == signal_name]
-                    },
+                    "Formula Parameters": {"$inputsignal": catalog.item(signal_name)},
                 },
                 {
                     "Name": f"{signal_name}: Standard Deviation",
                     "Type": "Signal",
                     "Formula": stddev_formula_string,
-                    "Formula Parameters": {
-                        "$inputsignal": signals[signals["Name"] == signal_name]
-                    },
+                    "Formula Parameters": {"$inputsignal": catalog.item(signal_name)},
                 },
             ]
         )
+    if grade_parameters:
+        mean_stddev_signal_df["Formula Parameters"] = [
+            {**parameters, **grade_parameters}
+            for parameters in mean_stddev_signal_df["Formula Parameters"]
+        ]
     return mean_stddev_signal_df
 
 
 def create_limit_signals(mean_stddev_push_df, signal_name):
+    generated_items = ItemCatalog(mean_stddev_push_df)
     limits_df = pd.DataFrame(
         [
             {
@@ -392,13 +1476,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean + 1*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
             {
@@ -406,13 +1487,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean - 1*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
             {
@@ -420,13 +1498,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean + 2*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
             {
@@ -434,13 +1509,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean - 2*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
             {
@@ -448,13 +1520,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean + 3*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
             {
@@ -462,13 +1531,10 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
                 "Type": "Signal",
                 "Formula": "$Mean - 3*$StandardDeviation",
                 "Formula Parameters": {
-                    "$Mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
-                    "$StandardDeviation": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"]
-                        == f"{signal_name}: Standard Deviation"
-                    ],
+                    "$Mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$StandardDeviation": generated_items.item(
+                        f"{signal_name}: Standard Deviation"
+                    ),
                 },
             },
         ]
@@ -476,13 +1542,31 @@ def create_limit_signals(mean_stddev_push_df, signal_name):
     return limits_df
 
 
-def western_electric_df(
-    limits_push_df, mean_stddev_push_df, signal_name, interp_value, signals
-):
-    input_signal = signals[signals["Name"] == signal_name]
+def rule_input(signal_name, interp_value, catalog, apply_to_condition=None):
     # in order to handle discrete, we want to coerce to step using the max interp specified on the UI
-    is_discrete = (input_signal["Interpolation Method"] == "None").any()
+    is_discrete = catalog.interpolation_method(signal_name) == "None"
     input_coercion_fragment = f".toStep({interp_value})" if is_discrete else ""
+    input_parameters = {"$inputsignal": catalog.item(signal_name)}
+    # scoped rules only see the samples within the apply to condition, where the limits are defined
+    if apply_to_condition is not None:
+        input_coercion_fragment += ".within($applytocondition)"
+        input_parameters["$applytocondition"] = catalog.item(apply_to_condition.v_model)
+    return input_coercion_fragment, input_parameters
+
+
+def western_electric_df(
+    limits_push_df,
+    mean_stddev_push_df,
+    signal_name,
+    interp_value,
+    catalog,
+    apply_to_condition=None,
+):
+    input_coercion_fragment, input_parameters = rule_input(
+        signal_name, interp_value, catalog, apply_to_condition
+    )
+    limits = ItemCatalog(limits_push_df)
+    generated_items = ItemCatalog(mean_stddev_push_df)
     western_electric_rules_df = pd.DataFrame(
         [
             {
@@ -490,13 +1574,9 @@ def western_electric_df(
                 "Type": "Condition",
                 "Formula": f"$inputsignal{input_coercion_fragment}.WesternElectricRunRules{ADD_ON_SUFFIX}_RunRule1($minus3sd, $plus3sd)",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus3sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -3 Sigma"
-                    ],
-                    "$plus3sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +3 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus3sd": limits.item(f"{signal_name}: -3 Sigma"),
+                    "$plus3sd": limits.item(f"{signal_name}: +3 Sigma"),
                 },
             },
             {
@@ -506,13 +1586,9 @@ def western_electric_df(
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus2sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -2 Sigma"
-                    ],
-                    "$plus2sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +2 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus2sd": limits.item(f"{signal_name}: -2 Sigma"),
+                    "$plus2sd": limits.item(f"{signal_name}: +2 Sigma"),
                 },
             },
             {
@@ -522,13 +1598,9 @@ def western_electric_df(
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -1 Sigma"
-                    ],
-                    "$plus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +1 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus1sd": limits.item(f"{signal_name}: -1 Sigma"),
+                    "$plus1sd": limits.item(f"{signal_name}: +1 Sigma"),
                 },
             },
             {
@@ -538,10 +1610,8 @@ def western_electric_df(
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
+                    **input_parameters,
+                    "$mean": generated_items.item(f"{signal_name}: Mean"),
                 },
             },
         ]
@@ -549,11 +1619,19 @@ def western_electric_df(
     return western_electric_rules_df
 
 
-def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, signals):
-    input_signal = signals[signals["Name"] == signal_name]
-    # in order to handle discrete, we want to coerce to step using the max interp specified on the UI
-    is_discrete = (input_signal["Interpolation Method"] == "None").any()
-    input_coercion_fragment = f".toStep({interp_value})" if is_discrete else ""
+def nelson_df(
+    limits_push_df,
+    mean_stddev_push_df,
+    signal_name,
+    interp_value,
+    catalog,
+    apply_to_condition=None,
+):
+    input_coercion_fragment, input_parameters = rule_input(
+        signal_name, interp_value, catalog, apply_to_condition
+    )
+    limits = ItemCatalog(limits_push_df)
+    generated_items = ItemCatalog(mean_stddev_push_df)
 
     nelson_rules_df = pd.DataFrame(
         [
@@ -562,13 +1640,9 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 "Type": "Condition",
                 "Formula": f"$inputsignal{input_coercion_fragment}.NelsonRunRules{ADD_ON_SUFFIX}_RunRule1($minus3sd, $plus3sd)",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus3sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -3 Sigma"
-                    ],
-                    "$plus3sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +3 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus3sd": limits.item(f"{signal_name}: -3 Sigma"),
+                    "$plus3sd": limits.item(f"{signal_name}: +3 Sigma"),
                 },
             },
             {
@@ -578,10 +1652,8 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$mean": mean_stddev_push_df[
-                        mean_stddev_push_df["Name"] == f"{signal_name}: Mean"
-                    ],
+                    **input_parameters,
+                    "$mean": generated_items.item(f"{signal_name}: Mean"),
                 },
             },
             {
@@ -590,7 +1662,7 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 "Formula": f"$inputsignal{input_coercion_fragment}.NelsonRunRules{ADD_ON_SUFFIX}_RunRule3("
                 + interp_value
                 + ")",
-                "Formula Parameters": {"$inputsignal": input_signal},
+                "Formula Parameters": {**input_parameters},
             },
             {
                 "Name": f"{signal_name}: Nelson Run Rule 4",
@@ -598,7 +1670,7 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 "Formula": f"$inputsignal{input_coercion_fragment}.NelsonRunRules{ADD_ON_SUFFIX}_RunRule4("
                 + interp_value
                 + ")",
-                "Formula Parameters": {"$inputsignal": input_signal},
+                "Formula Parameters": {**input_parameters},
             },
             {
                 "Name": f"{signal_name}: Nelson Run Rule 5",
@@ -607,13 +1679,9 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus2sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -2 Sigma"
-                    ],
-                    "$plus2sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +2 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus2sd": limits.item(f"{signal_name}: -2 Sigma"),
+                    "$plus2sd": limits.item(f"{signal_name}: +2 Sigma"),
                 },
             },
             {
@@ -623,13 +1691,9 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -1 Sigma"
-                    ],
-                    "$plus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +1 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus1sd": limits.item(f"{signal_name}: -1 Sigma"),
+                    "$plus1sd": limits.item(f"{signal_name}: +1 Sigma"),
                 },
             },
             {
@@ -639,13 +1703,9 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -1 Sigma"
-                    ],
-                    "$plus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +1 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus1sd": limits.item(f"{signal_name}: -1 Sigma"),
+                    "$plus1sd": limits.item(f"{signal_name}: +1 Sigma"),
                 },
             },
             {
@@ -655,13 +1715,9 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
                 + interp_value
                 + ")",
                 "Formula Parameters": {
-                    "$inputsignal": input_signal,
-                    "$minus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: -1 Sigma"
-                    ],
-                    "$plus1sd": limits_push_df[
-                        limits_push_df["Name"] == f"{signal_name}: +1 Sigma"
-                    ],
+                    **input_parameters,
+                    "$minus1sd": limits.item(f"{signal_name}: -1 Sigma"),
+                    "$plus1sd": limits.item(f"{signal_name}: +1 Sigma"),
                 },
             },
         ]
@@ -669,7 +1725,71 @@ def nelson_df(limits_push_df, mean_stddev_push_df, signal_name, interp_value, si
     return nelson_rules_df
 
 
-def within_condition_signal_df(signal_name, input_condition, signals, conditions):
+def combined_rules_df(
+    rules_name,
+    limits_push_df,
+    mean_stddev_push_df,
+    signal_name,
+    interp_value,
+    catalog,
+    apply_to_condition=None,
+):
+    input_coercion_fragment, input_parameters = rule_input(
+        signal_name, interp_value, catalog, apply_to_condition
+    )
+    limits = ItemCatalog(limits_push_df)
+    generated_items = ItemCatalog(mean_stddev_push_df)
+    combined_rules_df = pd.DataFrame(
+        [
+            {
+                "Name": f"{signal_name}: {rules_name} Run Rules",
+                "Type": "Condition",
+                "Formula": f"$inputsignal{input_coercion_fragment}.{RULE_PACKAGES[rules_name]}{ADD_ON_SUFFIX}_AllRules($mean, $minus1sd, $plus1sd, $minus2sd, $plus2sd, $minus3sd, $plus3sd, "
+                + interp_value
+                + ")",
+                "Formula Parameters": {
+                    **input_parameters,
+                    "$mean": generated_items.item(f"{signal_name}: Mean"),
+                    "$minus1sd": limits.item(f"{signal_name}: -1 Sigma"),
+                    "$plus1sd": limits.item(f"{signal_name}: +1 Sigma"),
+                    "$minus2sd": limits.item(f"{signal_name}: -2 Sigma"),
+                    "$plus2sd": limits.item(f"{signal_name}: +2 Sigma"),
+                    "$minus3sd": limits.item(f"{signal_name}: -3 Sigma"),
+                    "$plus3sd": limits.item(f"{signal_name}: +3 Sigma"),
+                },
+            }
+        ]
+    )
+    return combined_rules_df
+
+
+def rule_episodes(rules_df, rules_name, episode_duration):
+    # violations are merged into episodes of at most episode_duration instead of one capsule per
+    # sample, the episodes carry the violation count and first and last sample times
+    rules_df = rules_df.copy()
+    episodes = f"{RULE_PACKAGES[rules_name]}{ADD_ON_SUFFIX}_RuleEpisodes($inputsignal, {episode_duration})"
+    rules_df["Formula"] = [
+        (
+            combined_rule_episodes(formula, rules_name, episodes)
+            if name.endswith(" Run Rules")
+            else f"({formula}).{episodes}"
+        )
+        for name, formula in zip(rules_df["Name"], rules_df["Formula"])
+    ]
+    return rules_df
+
+
+def combined_rule_episodes(formula, rules_name, episodes):
+    # merging drops capsule properties, so the episodes of each rule are merged on their own and
+    # get their Rule property back, the same property the AllRules capsules carry
+    episode_formulas = ",\n".join(
+        f"$rules.keep('Rule', isMatch('Rule {rule}')).{episodes}.setProperty('Rule', 'Rule {rule}')"
+        for rule in RULE_LIMITS[rules_name]
+    )
+    return f"$rules = {formula}\ncombinewith(\n{episode_formulas}\n)"
+
+
+def within_condition_signal_df(signal_name, input_condition, catalog):
     within_signal_df = pd.DataFrame(
         [
             {
@@ -677,10 +1797,8 @@ def within_condition_signal_df(signal_name, input_condition, signals, conditions
                 "Type": "Signal",
                 "Formula": "$inputsignal.remove(not $inputcondition)",
                 "Formula Parameters": {
-                    "$inputsignal": signals[signals["Name"] == signal_name],
-                    "$inputcondition": conditions[
-                        conditions["Name"] == input_condition.v_model
-                    ],
+                    "$inputsignal": catalog.item(signal_name),
+                    "$inputcondition": catalog.item(input_condition.v_model),
                 },
             }
         ]
@@ -688,164 +1806,261 @@ def within_condition_signal_df(signal_name, input_condition, signals, conditions
     return within_signal_df
 
 
-def create_histogram(
-    signal_df,
+def create_histograms(
+    signal_dfs,
+    histogram_hashes,
     start_time,
     end_time,
     input_condition,
-    conditions,
+    catalog,
     workbook_id,
     capsule_property,
+    run_id=None,
 ):
-    formulaAPI = sdk.FormulasApi(spy.client)
-    itemsAPI = sdk.ItemsApi(spy.client)
-
-    data = spy.pull(signal_df, grid=None, quiet=True, start=start_time, end=end_time)
-    signal_name = signal_df["Name"].iloc[0]
-    matching_columns = [col for col in data.columns if signal_name in col]
-    if matching_columns:
-        if isinstance(capsule_property.v_model, str):
-            column_name = matching_columns[0]
-            max_value = data[column_name].mean() + 4 * data[column_name].std()
-            min_value = data[column_name].mean() - 4 * data[column_name].std()
-            number_of_bins = 2 * math.ceil(
-                (1 + 3.322 * math.log10(data[column_name].count()))
-            )
-            fxn_input_step1 = sdk.FunctionInputV1(
-                name=f"{signal_name} Histogram",
-                scoped_to=workbook_id,
-                type="Chart",
-                formula='conditionTable($condition1.toGroup($viewCapsule, CapsuleBoundary.Intersect), "'
-                + capsule_property.v_model
-                + '", $yValueSignal2.toStates(capsule('
-                + str(min_value)
-                + ", "
-                + str(max_value)
-                + ").partition("
-                + str((max_value - min_value) / number_of_bins)
-                + ')).toCondition("yValueCol2").toGroup($viewCapsule, CapsuleBoundary.Intersect), "yValueCol2").addStatColumn("signalToAggregate", $signalToAggregate, count())',
-                parameters=[
-                    sdk.FormulaParameterInputV1(
-                        name="condition1",
-                        id=conditions[conditions["Name"] == input_condition.v_model][
-                            "ID"
-                        ].iloc[0],
-                    ),
-                    sdk.FormulaParameterInputV1(
-                        name="yValueSignal2", id=signal_df["ID"].iloc[0]
-                    ),
-                    sdk.FormulaParameterInputV1(
-                        name="signalToAggregate", id=signal_df["ID"].iloc[0]
-                    ),
-                    sdk.FormulaParameterInputV1(
-                        unbound=True,
-                        name="viewCapsule",
-                        formula='capsule("'
-                        + str(start_time)
-                        + '", "'
-                        + str(end_time)
-                        + '")',
-                    ),
-                ],
-            )
-            step1 = formulaAPI.create_function(body=fxn_input_step1)
-            # Setting UIConfig property to mimic Histogram Tool UI
-            step2 = itemsAPI.set_property(
-                property_name="UIConfig",
-                id=step1.id,
-                body=sdk.PropertyInputV1(
-                    value='{"type":"aggregation-bins-table","advancedParametersCollapsed":true,"mode":"by_y_value","includeEmptyBuckets":false,"yValueSignal1":"","stat":{"key":"count","timeUnits":"s","percentile":null},"aggregationConfigs":[{"id":1,"mode":"by_condition","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
-                    + str(min_value)
-                    + ',"yValueBinMax":'
-                    + str(max_value)
-                    + ',"numberOfBins":"'
-                    + str(number_of_bins)
-                    + '","conditionProperty":"'
-                    + capsule_property.v_model
-                    + '"},{"id":2,"mode":"by_y_value","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
-                    + str(min_value)
-                    + ',"yValueBinMax":'
-                    + str(max_value)
-                    + ',"numberOfBins":"'
-                    + str(number_of_bins)
-                    + '","conditionProperty":"'
-                    + capsule_property.v_model
-                    + '"}]}'
+    # the statistics of every signal come from one formula, then each histogram function is
+    # created with its UIConfig and content hash in one call and run once to build it, with the
+    # signals handled concurrently. A failed signal gets its exception instead of an ID
+    if not signal_dfs:
+        return {}
+    try:
+        statistics = dict(
+            zip(
+                signal_dfs,
+                window_statistics(
+                    [signal_df["ID"].iloc[0] for signal_df in signal_dfs.values()],
+                    start_time,
+                    end_time,
                 ),
             )
-            # Running of histogram function to actually create the histogram
-            step3 = formulaAPI.run_formula(
-                function=step1.id,
-                fragments=[
-                    'viewCapsule=capsule("'
-                    + str(start_time)
-                    + '","'
-                    + str(end_time)
-                    + '")'
-                ],
-            )
+        )
+    except API_ERRORS:
+        # each histogram then pulls the raw samples of its signal, a failed pull only fails that signal
+        statistics = {}
+
+    def create_histogram(signal_name, signal_df):
+        if signal_name in statistics:
+            mean, std, count = statistics[signal_name]
         else:
-            column_name = matching_columns[0]
-            max_value = data[column_name].mean() + 4 * data[column_name].std()
-            min_value = data[column_name].mean() - 4 * data[column_name].std()
-            number_of_bins = math.ceil(
-                (1 + 3.322 * math.log10(data[column_name].count()))
-            )
-            fxn_input_step1 = sdk.FunctionInputV1(
-                name=f"{signal_name} Histogram",
-                scoped_to=workbook_id,
-                type="Chart",
-                formula="conditionTable($yValueSignal1.toStates(capsule("
-                + str(min_value)
-                + ", "
-                + str(max_value)
-                + ").partition("
-                + str((max_value - min_value) / number_of_bins)
-                + ')).toCondition("yValueCol1").toGroup($viewCapsule, CapsuleBoundary.Intersect), "yValueCol1", capsule('
-                + str(min_value)
-                + ", "
-                + str(max_value)
-                + ").partition("
-                + str((max_value - min_value) / number_of_bins)
-                + ').property("value")).addStatColumn("signalToAggregate", $signalToAggregate, count())',
-                parameters=[
-                    sdk.FormulaParameterInputV1(
-                        name="yValueSignal1", id=signal_df["ID"].iloc[0]
-                    ),
-                    sdk.FormulaParameterInputV1(
-                        name="signalToAggregate", id=signal_df["ID"].iloc[0]
-                    ),
-                    sdk.FormulaParameterInputV1(
-                        unbound=True,
-                        name="viewCapsule",
-                        formula='capsule("'
-                        + str(start_time)
-                        + '", "'
-                        + str(end_time)
-                        + '")',
-                    ),
-                ],
+            mean, std, count = sample_statistics(signal_df, start_time, end_time)
+        if not count:
+            raise ValueError(
+                f"No samples found for '{signal_name}' in the training window"
             )
-            step1 = formulaAPI.create_function(body=fxn_input_step1)
-            # Setting UIConfig property to mimic Histogram Tool UI
-            step2 = itemsAPI.set_property(
-                property_name="UIConfig",
-                id=step1.id,
-                body=sdk.PropertyInputV1(
-                    value='{"type":"aggregation-bins-table","advancedParametersCollapsed":true,"mode":"by_y_value","includeEmptyBuckets":false,"yValueSignal1":"","stat":{"key":"count","timeUnits":"s","percentile":null},"aggregationConfigs":[{"id":1,"mode":"by_y_value","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
-                    + str(min_value)
-                    + ',"yValueBinMax":'
-                    + str(max_value)
-                    + ',"numberOfBins":"'
-                    + str(number_of_bins)
-                    + '"}]}'
-                ),
+        histogram = formulaAPI.create_function(
+            body=histogram_function_input(
+                signal_df,
+                mean,
+                std,
+                count,
+                start_time,
+                end_time,
+                input_condition,
+                catalog,
+                workbook_id,
+                capsule_property,
+                histogram_hashes[signal_name],
+                run_id,
             )
+        )
         # Running of histogram function to actually create the histogram
-        step3 = formulaAPI.run_formula(
-            function=step1.id,
+        formulaAPI.run_formula(
+            function=histogram.id,
             fragments=[f'viewCapsule=capsule("{start_time}","{end_time}")'],
         )
+        return histogram.id
+
+    with ThreadPoolExecutor(max_workers=HISTOGRAM_WORKERS) as executor:
+        futures = {
+            signal_name: executor.submit(create_histogram, signal_name, signal_df)
+            for signal_name, signal_df in signal_dfs.items()
+        }
+    histogram_ids = {}
+    for signal_name, future in futures.items():
+        try:
+            histogram_ids[signal_name] = future.result()
+        except Exception as e:
+            histogram_ids[signal_name] = e
+    return histogram_ids
+
+
+def histogram_function_input(
+    signal_df,
+    mean,
+    std,
+    count,
+    start_time,
+    end_time,
+    input_condition,
+    catalog,
+    workbook_id,
+    capsule_property,
+    histogram_hash,
+    run_id=None,
+):
+    signal_name = signal_df["Name"].iloc[0]
+    max_value = mean + 4 * std
+    min_value = mean - 4 * std
+    view_capsule = sdk.FormulaParameterInputV1(
+        unbound=True,
+        name="viewCapsule",
+        formula='capsule("' + str(start_time) + '", "' + str(end_time) + '")',
+    )
+    if isinstance(capsule_property.v_model, str):
+        number_of_bins = 2 * math.ceil((1 + 3.322 * math.log10(count)))
+        formula = (
+            'conditionTable($condition1.toGroup($viewCapsule, CapsuleBoundary.Intersect), "'
+            + capsule_property.v_model
+            + '", $yValueSignal2.toStates(capsule('
+            + str(min_value)
+            + ", "
+            + str(max_value)
+            + ").partition("
+            + str((max_value - min_value) / number_of_bins)
+            + ')).toCondition("yValueCol2").toGroup($viewCapsule, CapsuleBoundary.Intersect), "yValueCol2").addStatColumn("signalToAggregate", $signalToAggregate, count())'
+        )
+        parameters = [
+            sdk.FormulaParameterInputV1(
+                name="condition1",
+                id=catalog.id(input_condition.v_model),
+            ),
+            sdk.FormulaParameterInputV1(
+                name="yValueSignal2", id=signal_df["ID"].iloc[0]
+            ),
+            sdk.FormulaParameterInputV1(
+                name="signalToAggregate", id=signal_df["ID"].iloc[0]
+            ),
+            view_capsule,
+        ]
+        # UIConfig property to mimic Histogram Tool UI
+        ui_config = (
+            '{"type":"aggregation-bins-table","advancedParametersCollapsed":true,"mode":"by_y_value","includeEmptyBuckets":false,"yValueSignal1":"","stat":{"key":"count","timeUnits":"s","percentile":null},"aggregationConfigs":[{"id":1,"mode":"by_condition","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
+            + str(min_value)
+            + ',"yValueBinMax":'
+            + str(max_value)
+            + ',"numberOfBins":"'
+            + str(number_of_bins)
+            + '","conditionProperty":"'
+            + capsule_property.v_model
+            + '"},{"id":2,"mode":"by_y_value","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
+            + str(min_value)
+            + ',"yValueBinMax":'
+            + str(max_value)
+            + ',"numberOfBins":"'
+            + str(number_of_bins)
+            + '","conditionProperty":"'
+            + capsule_property.v_model
+            + '"}]}'
+        )
     else:
-        print(f"No column found in data matching '{signal_name}'.")
-    return step1.id
+        number_of_bins = math.ceil((1 + 3.322 * math.log10(count)))
+        formula = (
+            "conditionTable($yValueSignal1.toStates(capsule("
+            + str(min_value)
+            + ", "
+            + str(max_value)
+            + ").partition("
+            + str((max_value - min_value) / number_of_bins)
+            + ')).toCondition("yValueCol1").toGroup($viewCapsule, CapsuleBoundary.Intersect), "yValueCol1", capsule('
+            + str(min_value)
+            + ", "
+            + str(max_value)
+            + ").partition("
+            + str((max_value - min_value) / number_of_bins)
+            + ').property("value")).addStatColumn("signalToAggregate", $signalToAggregate, count())'
+        )
+        parameters = [
+            sdk.FormulaParameterInputV1(
+                name="yValueSignal1", id=signal_df["ID"].iloc[0]
+            ),
+            sdk.FormulaParameterInputV1(
+                name="signalToAggregate", id=signal_df["ID"].iloc[0]
+            ),
+            view_capsule,
+        ]
+        # UIConfig property to mimic Histogram Tool UI
+        ui_config = (
+            '{"type":"aggregation-bins-table","advancedParametersCollapsed":true,"mode":"by_y_value","includeEmptyBuckets":false,"yValueSignal1":"","stat":{"key":"count","timeUnits":"s","percentile":null},"aggregationConfigs":[{"id":1,"mode":"by_y_value","capsuleMode":"intersect","yValueBinMode":"number","valid":true,"yValueBinMin":'
+            + str(min_value)
+            + ',"yValueBinMax":'
+            + str(max_value)
+            + ',"numberOfBins":"'
+            + str(number_of_bins)
+            + '"}]}'
+        )
+    # the UIConfig, content hash and run ID are set with the function instead of set_property calls
+    additional_properties = [
+        sdk.ScalarPropertyV1(name="UIConfig", value=ui_config),
+        sdk.ScalarPropertyV1(name=CONTENT_HASH_PROPERTY, value=histogram_hash),
+    ]
+    if run_id is not None:
+        additional_properties.append(
+            sdk.ScalarPropertyV1(name=RUN_ID_PROPERTY, value=run_id)
+        )
+    return sdk.FunctionInputV1(
+        name=f"{signal_name} Histogram",
+        scoped_to=workbook_id,
+        type="Chart",
+        formula=formula,
+        parameters=parameters,
+        additional_properties=additional_properties,
+    )
+
+
+def window_statistics(signal_ids, start_time, end_time):
+    # the sample statistics for the bin ranges of all signals are computed by the server in a
+    # single formula, toDiscrete() gives unweighted statistics like the samples pulled with grid=None
+    window_seconds = math.ceil(
+        (pd.Timestamp(end_time) - pd.Timestamp(start_time)).total_seconds()
+    )
+    formula = f"condition({window_seconds + 1}s, capsule('{start_time}', '{end_time}'))"
+    for i in range(len(signal_ids)):
+        formula += (
+            f"\n.setProperty('Mean {i}', $signal{i}.toDiscrete(), average())"
+            f"\n.setProperty('StdDev {i}', $signal{i}.toDiscrete(), stdDev())"
+            f"\n.setProperty('Count {i}', $signal{i}.toDiscrete(), count())"
+        )
+    output = formulaAPI.run_formula(
+        start=str(start_time),
+        end=str(end_time),
+        formula=formula,
+        parameters=[f"signal{i}={signal_id}" for i, signal_id in enumerate(signal_ids)],
+    )
+    properties = {
+        prop.name: prop.value for prop in output.capsules.capsules[0].properties
+    }
+    # a signal without samples in the window has no statistics
+    return [
+        (
+            float(properties.get(f"Mean {i}", math.nan)),
+            float(properties.get(f"StdDev {i}", math.nan)),
+            int(float(properties.get(f"Count {i}", 0))),
+        )
+        for i in range(len(signal_ids))
+    ]
+
+
+def sample_statistics(signal_df, start_time, end_time):
+    # fallback when the statistics formula cannot be run, the raw samples are pulled one shard
+    # of the window at a time so only the running moments are kept in memory
+    signal_name = signal_df["Name"].iloc[0]
+    moments = MomentAccumulator()
+    shard_starts = pd.date_range(
+        pd.Timestamp(start_time), pd.Timestamp(end_time), freq=SAMPLE_SHARD
+    )
+    for shard_start, shard_end in zip(
+        shard_starts, list(shard_starts[1:]) + [pd.Timestamp(end_time)]
+    ):
+        if shard_start >= shard_end:
+            continue
+        # shards end just before the next one starts so a boundary sample is only counted once
+        if shard_end != pd.Timestamp(end_time):
+            shard_end -= pd.Timedelta(1, "ns")
+        data = spy.pull(
+            signal_df, grid=None, quiet=True, start=shard_start, end=shard_end
+        )
+        matching_columns = [col for col in data.columns if signal_name in col]
+        if matching_columns:
+            moments.add(data[matching_columns[0]].to_numpy())
+    if moments.count == 0:
+        return None, None, 0
+    return moments.mean, moments.std, moments.count
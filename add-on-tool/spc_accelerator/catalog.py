@@ -0,0 +1,67 @@
+import threading
+import pandas as pd
+
+
+class ItemCatalog:
+    """
+    Worksheet items and the items generated from them, indexed by name and ID. Lookups
+    by name return one row frames that can be used directly as formula parameters.
+    """
+
+    def __init__(self, items=None):
+        self._lock = threading.Lock()
+        self._by_name = {}
+        self._by_id = {}
+        self._frames = {}
+        if items is not None:
+            self.add(items)
+
+    def add(self, items):
+        # generated items are added from the task graph threads as they are pushed
+        with self._lock:
+            for item in items.to_dict("records"):
+                self._by_name[item["Name"]] = item
+                self._frames.pop(item["Name"], None)
+                if isinstance(item.get("ID"), str):
+                    self._by_id[item["ID"]] = item
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name in self._by_name
+
+    def item(self, name):
+        # unknown names give an empty frame, the same result as filtering a frame by name
+        if name not in self:
+            return pd.DataFrame(columns=["Name", "ID", "Type"])
+        frame = self._frames.get(name)
+        if frame is None:
+            frame = pd.DataFrame([self._by_name[name]])
+            self._frames[name] = frame
+        return frame
+
+    def id(self, name):
+        return self._by_name[name]["ID"]
+
+    def type(self, name):
+        return self._by_name[name]["Type"]
+
+    def interpolation_method(self, name):
+        return self._by_name[name].get("Interpolation Method")
+
+    def units(self, name):
+        return self._by_name[name].get("Value Unit Of Measure")
+
+    def name(self, item_id):
+        return self._by_id[item_id]["Name"]
+
+    def items_by_id(self, item_ids):
+        return pd.DataFrame(
+            [
+                {
+                    "Name": self._by_id[item_id]["Name"],
+                    "ID": item_id,
+                    "Type": self._by_id[item_id]["Type"],
+                }
+                for item_id in item_ids
+            ],
+            columns=["Name", "ID", "Type"],
+        )
@@ -57,9 +57,36 @@ def frontend(signal_list, condition_list, start_time, end_time):
     control_chart = v.Checkbox(v_model=True, readonly=True, label="Control Chart")
     we_runrules = v.Checkbox(v_model=False, label="Western Electric Run Rules")
     nelson_runrules = v.Checkbox(v_model=False, label="Nelson Run Rules")
+    # only the picked rules of a checked rule set are created
+    we_rules = v.Select(
+        v_model=[1, 2, 3, 4],
+        items=[{"text": f"Rule {rule}", "value": rule} for rule in range(1, 5)],
+        multiple=True,
+        chips=True,
+        dense=True,
+        label="Western Electric Rules",
+    )
+    nelson_rules = v.Select(
+        v_model=[1, 2, 3, 4, 5, 6, 7, 8],
+        items=[{"text": f"Rule {rule}", "value": rule} for rule in range(1, 9)],
+        multiple=True,
+        chips=True,
+        dense=True,
+        label="Nelson Rules",
+    )
     histogram = v.Checkbox(v_model=False, label="Histogram Normality Check")
+    # many signals share a few summary worksheets instead of getting worksheets each
+    summary_worksheets = v.Checkbox(v_model=False, label="Summary Worksheets")
+    # items and worksheets of earlier runs that this run no longer uses are archived
+    archive_superseded = v.Checkbox(v_model=False, label="Archive Earlier Runs")
 
     button = v.Btn(children=["Execute"], class_="execute mr-1", loading=False)
+    cancel_button = v.Btn(
+        children=["Cancel"],
+        class_="mr-1",
+        outlined=True,
+        disabled=True,
+    )
     workbook_button = v.Btn(
         children=[v.Icon(children=["mdi-open-in-new"])],
         color="primary",
@@ -92,9 +119,14 @@ def frontend(signal_list, condition_list, start_time, end_time):
         apply_to_condition,
         control_chart,
         we_runrules,
+        we_rules,
         nelson_runrules,
+        nelson_rules,
         histogram,
+        summary_worksheets,
+        archive_superseded,
         button,
+        cancel_button,
         workbook_button,
         error,
         success,
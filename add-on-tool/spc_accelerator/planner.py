@@ -0,0 +1,133 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class TaskGraph:
+    """
+    Task graph with one node per artifact of a control chart run. Nodes whose
+    dependencies are done run concurrently on a bounded thread pool.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, function, dependencies=(), after=(), group=None, enabled=True):
+        # dependencies pass their results to function in order, after only orders the execution
+        # so the node also runs when those nodes failed or were skipped
+        self.tasks[name] = {
+            "function": function,
+            "dependencies": list(dependencies),
+            "after": list(after),
+            "group": group,
+            "status": "pending" if enabled else "disabled",
+            "result": None,
+            "error": None,
+            "duration": None,
+        }
+
+    def graph(self):
+        return {
+            name: task["dependencies"] + task["after"]
+            for name, task in self.tasks.items()
+        }
+
+    def timings(self):
+        return {
+            name: task["duration"]
+            for name, task in self.tasks.items()
+            if task["duration"] is not None
+        }
+
+    def result(self, name):
+        return self.tasks[name]["result"]
+
+    def status(self, name):
+        return self.tasks[name]["status"]
+
+    def group_tasks(self, group):
+        return [name for name, task in self.tasks.items() if task["group"] == group]
+
+    def group_incomplete(self, group, names=None):
+        # True when a node of the group failed or was skipped because of a failure
+        return any(
+            self.tasks[name]["status"] in ("failed", "skipped")
+            for name in self.group_tasks(group)
+            if names is None or name in names
+        )
+
+    def fail(self, name, error):
+        # a node that completed can still fail in a later node, e.g. when its item is pushed
+        self.tasks[name]["error"] = error
+        self.tasks[name]["status"] = "failed"
+
+    def group_errors(self, group):
+        return [
+            self.tasks[name]["error"]
+            for name in self.group_tasks(group)
+            if self.tasks[name]["status"] == "failed"
+        ]
+
+    def _ready(self):
+        # nodes that can never run because a dependency failed, was skipped or is disabled are skipped
+        skipped = True
+        while skipped:
+            skipped = False
+            for task in self.tasks.values():
+                if task["status"] == "pending" and any(
+                    self.tasks[d]["status"] in ("failed", "skipped", "disabled")
+                    for d in task["dependencies"]
+                ):
+                    task["status"] = "skipped"
+                    skipped = True
+        return [
+            name
+            for name, task in self.tasks.items()
+            if task["status"] == "pending"
+            and all(self.tasks[d]["status"] == "done" for d in task["dependencies"])
+            and all(
+                self.tasks[a]["status"] in ("done", "failed", "skipped", "disabled")
+                for a in task["after"]
+            )
+        ]
+
+    def _run_task(self, name):
+        task = self.tasks[name]
+        start = time.perf_counter()
+        try:
+            return task["function"](
+                *[self.tasks[d]["result"] for d in task["dependencies"]]
+            )
+        finally:
+            task["duration"] = time.perf_counter() - start
+
+    def run(self, max_workers=1, progress=None, cancel_event=None):
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+            while True:
+                if cancel_event is None or not cancel_event.is_set():
+                    for name in self._ready():
+                        self.tasks[name]["status"] = "running"
+                        running[executor.submit(self._run_task, name)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.tasks[name]["result"] = future.result()
+                        self.tasks[name]["status"] = "done"
+                    except Exception as e:
+                        self.tasks[name]["error"] = str(e)
+                        self.tasks[name]["status"] = "failed"
+                    if progress is not None:
+                        progress(name)
+        if cancel_event is not None and cancel_event.is_set():
+            raise RunCancelled()
+        pending = [n for n, t in self.tasks.items() if t["status"] == "pending"]
+        if pending:
+            raise ValueError(f"Dependency cycle between tasks: {', '.join(pending)}")
+        return self
@@ -0,0 +1,144 @@
+from seeq import spy, sdk
+import json
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+# item property holding the ID of the run an item was pushed by, reused items keep their first run
+RUN_ID_PROPERTY = "SPC Run ID"
+# workbook property holding the items and worksheets of every run as JSON
+REGISTRY_PROPERTY = "SPC Run Registry"
+# number of archive calls submitted concurrently, the SDK archives one item or worksheet per call
+ARCHIVE_WORKERS = 8
+# number of runs the registry lists, older runs are merged into one entry so none of their
+# items are lost to a later cleanup
+MAX_RUNS = 20
+
+
+class RunRegistry:
+    """
+    Items and worksheets generated by the control chart runs of a workbook, kept as a
+    property of the workbook. A run is superseded once later runs completed all of its
+    signals, its items and worksheets are then archived together unless a run that is
+    not superseded still uses them.
+    """
+
+    def __init__(self, workbook_id):
+        self.workbook_id = workbook_id
+
+    def runs(self):
+        properties = (
+            sdk.ItemsApi(spy.client)
+            .get_item_and_all_properties(id=self.workbook_id)
+            .properties
+        )
+        for prop in properties:
+            if prop.name == REGISTRY_PROPERTY and prop.value:
+                return json.loads(prop.value)
+        return {}
+
+    def register(self, run_id, item_ids, worksheet_ids, signals, completed):
+        # an unchanged item is listed by every run that reused it, so it is only archived with
+        # the last of them. A cancelled or failed signal is listed but not completed, so the run
+        # does not supersede the earlier charts of that signal
+        runs = self.runs()
+        runs[run_id] = {
+            "Created": datetime.now(timezone.utc).isoformat(),
+            "Signals": sorted(set(signals)),
+            "Completed": sorted(set(completed)),
+            "Items": sorted(set(item_ids)),
+            "Worksheets": sorted(set(worksheet_ids)),
+        }
+        runs = merge_oldest_runs(runs)
+        self._save(runs)
+        return runs
+
+    def superseded(self, runs=None):
+        runs = self.runs() if runs is None else runs
+        covered = set()
+        superseded = []
+        for run_id in sorted(runs, key=lambda run_id: runs[run_id]["Created"])[::-1]:
+            if set(runs[run_id]["Signals"]) <= covered:
+                superseded.append(run_id)
+            covered.update(runs[run_id]["Completed"])
+        return superseded[::-1]
+
+    def archive_superseded(self):
+        runs = self.runs()
+        superseded = self.superseded(runs)
+        if not superseded:
+            return {"Runs": [], "Items": [], "Worksheets": []}
+        kept = [run_id for run_id in runs if run_id not in superseded]
+        stale = {
+            key: sorted(
+                {item_id for run_id in superseded for item_id in runs[run_id][key]}
+                - {item_id for run_id in kept for item_id in runs[run_id][key]}
+            )
+            for key in ("Items", "Worksheets")
+        }
+        items_api = sdk.ItemsApi(spy.client)
+        workbooks_api = sdk.WorkbooksApi(spy.client)
+        with ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+            futures = {
+                item_id: executor.submit(
+                    items_api.archive_item, id=item_id, archived_reason="BY_USER"
+                )
+                for item_id in stale["Items"]
+            }
+            futures.update(
+                {
+                    worksheet_id: executor.submit(
+                        workbooks_api.archive_worksheet,
+                        workbook_id=self.workbook_id,
+                        worksheet_id=worksheet_id,
+                    )
+                    for worksheet_id in stale["Worksheets"]
+                }
+            )
+        failed = set()
+        for archived_id, future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                failed.add(archived_id)
+        # a superseded run stays registered with what failed to archive, so a later cleanup retries it
+        for run_id in superseded:
+            remaining = {
+                key: [i for i in runs[run_id][key] if i in failed]
+                for key in ("Items", "Worksheets")
+            }
+            if any(remaining.values()):
+                runs[run_id].update(remaining)
+            else:
+                del runs[run_id]
+        self._save(runs)
+        return {
+            "Runs": superseded,
+            "Items": [i for i in stale["Items"] if i not in failed],
+            "Worksheets": [i for i in stale["Worksheets"] if i not in failed],
+        }
+
+    def _save(self, runs):
+        sdk.ItemsApi(spy.client).set_property(
+            id=self.workbook_id,
+            property_name=REGISTRY_PROPERTY,
+            body=sdk.PropertyInputV1(value=json.dumps(runs)),
+        )
+
+
+def merge_oldest_runs(runs, max_runs=MAX_RUNS):
+    # the merged entry covers the signals of all merged runs, so it is only superseded once
+    # later runs completed every one of them
+    if len(runs) <= max_runs:
+        return runs
+    ordered = sorted(runs, key=lambda run_id: runs[run_id]["Created"])
+    oldest = ordered[: len(runs) - max_runs + 1]
+    merged = {
+        "Created": runs[oldest[-1]]["Created"],
+        **{
+            key: sorted({value for run_id in oldest for value in runs[run_id][key]})
+            for key in ("Signals", "Completed", "Items", "Worksheets")
+        },
+    }
+    runs = {run_id: runs[run_id] for run_id in ordered[len(oldest) :]}
+    runs[oldest[0]] = merged
+    return runs
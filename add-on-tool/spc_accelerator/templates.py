@@ -1,6 +1,25 @@
 from seeq import spy, sdk
+import copy
 import json
+import re
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# colors of the generated items by name, the input signal and condition use INPUT_COLOR
+ITEM_COLORS = [
+    (r": Mean$", "#00b050"),
+    (r": [+-]1 Sigma$", "#a9a9a9"),
+    (r": [+-]2 Sigma$", "#ffc000"),
+    (r": [+-]3 Sigma$", "#ff0000"),
+    (r": .* Run Rule( \d+|s)$", "#ff0000"),
+]
+INPUT_COLOR = "#4055a3"
+# number of workstep patches submitted concurrently after the workbook push
+WORKSTEP_WORKERS = 8
+# page size of the worksheet listing the targeted template looks up existing worksheets in
+WORKSHEET_PAGE_SIZE = 1000
+# number of signals that share a worksheet in the summary layout, each gets its own lane
+SUMMARY_SIGNALS = 10
 
 
 def create_template(
@@ -13,173 +32,238 @@ def create_template(
     workbook_button,
     workbook_id,
     histogram_dict,
+    catalog,
+    targeted=False,
+    summary=False,
 ):
     workbooks_api = sdk.WorkbooksApi(spy.client)
-    wb = spy.workbooks.pull(URL, include_inventory=False, quiet=True)
-    ws = wb[0].worksheets
-    new_worksheet_ids = []
+    histogram_items = (
+        histogram_worksheets(histogram_dict, summary)
+        if histogram.v_model == True
+        else {}
+    )
+    # the targeted template only pulls the worksheets it updates instead of the whole workbook
+    worksheet_names = list(display_dict) + list(histogram_items)
+    wb = spy.workbooks.pull(
+        URL,
+        include_inventory=False,
+        specific_worksheet_ids=(
+            existing_worksheet_ids(workbooks_api, workbook_id, worksheet_names)
+            if targeted
+            else None
+        ),
+        quiet=True,
+    )
+    new_worksheets = []
     for worksheet_name, item_ids in display_dict.items():
-        display_df = spy.search(pd.DataFrame(item_ids, columns=["ID"]), quiet=True)[
-            ["Name", "ID", "Type"]
-        ].reset_index(drop=True)
-        display_df["Lane"] = 1
-        display_df["Axis Group"] = "A"
+        # pushed items are added to the catalog, so Name and Type need no search
+        display_df = catalog.items_by_id(item_ids)
         display_df["Samples Display"] = "Line"
-        display_df.at[7, "Samples Display"] = "Line and Sample"
         display_df["Line Style"] = "Long Dash"
-        display_df.at[7, "Line Style"] = "Solid"
-        display_df.at[0, "Color"] = "#00b050"
-        display_df.loc[1:2, "Color"] = "#a9a9a9"
-        display_df.loc[3:4, "Color"] = "#ffc000"
-        display_df.loc[5:6, "Color"] = "#ff0000"
-        if isinstance(input_condition.v_model, str):
-            display_df.loc[7:8, "Color"] = "#4055a3"
-            if len(display_df) > 9:
-                display_df.loc[9:, "Color"] = "#ff0000"
-        else:
-            display_df.at[7, "Color"] = "#4055a3"
-            if len(display_df) > 8:
-                display_df.loc[8:, "Color"] = "#ff0000"
-        worksheet = [w for w in ws if w.name == worksheet_name][0]
-        new_worksheet_ids += [worksheet.id]
+        # styled by item rather than position since a worksheet may hold only some limit lines
+        display_df["Color"] = display_df["Name"].map(item_color)
+        input_signal = (display_df["Color"] == INPUT_COLOR) & display_df[
+            "Type"
+        ].str.contains("Signal")
+        display_df.loc[input_signal, "Samples Display"] = "Line and Sample"
+        display_df.loc[input_signal, "Line Style"] = "Solid"
+        # every input signal gets a lane and axis shared with its mean, limits and rules
+        signal_names = display_df.loc[input_signal, "Name"].to_list()
+        display_df["Lane"] = [
+            signal_index(name, signal_names) + 1 for name in display_df["Name"]
+        ]
+        display_df["Axis Group"] = [
+            axis_group(signal_index(name, signal_names)) for name in display_df["Name"]
+        ]
+        # worksheets do not exist yet when the items were pushed in a single batch
+        worksheet = wb[0].worksheet(worksheet_name)
+        new_worksheets += [worksheet]
         worksheet.display_items = display_df
         worksheet.display_range = {"Start": start_select.value, "End": end_select.value}
-    if histogram.v_model == True:
-        for worksheet_name in histogram_dict:
-            worksheet = [w for w in ws if w.name == worksheet_name][0]
-            new_worksheet_ids += [worksheet.id]
-            worksheet.display_range = {
-                "Start": start_select.value,
-                "End": end_select.value,
-            }
-    spy.workbooks.push(wb, include_inventory=False, quiet=True)
-    first_new_worksheet = [w for w in ws if w.name == list(display_dict.keys())[0]][0]
+    for worksheet_name in histogram_items:
+        # histogram worksheets only show histograms, they are added to the workstep after the push
+        worksheet = wb[0].worksheet(worksheet_name)
+        new_worksheets += [worksheet]
+        worksheet.display_items = pd.DataFrame(columns=["Name", "Type", "ID"])
+        worksheet.display_range = {
+            "Start": start_select.value,
+            "End": end_select.value,
+        }
+    # new worksheets only have a local ID until they are pushed, it is what the push matches on
+    spy.workbooks.push(
+        wb,
+        include_inventory=False,
+        specific_worksheet_ids=(
+            [worksheet.id for worksheet in new_worksheets] if targeted else None
+        ),
+        quiet=True,
+    )
+    # the push refreshes the worksheet objects, so IDs of newly created worksheets are only read now
+    first_new_worksheet = new_worksheets[0]
     workbook_button.href = first_new_worksheet.url
-    for worksheet in new_worksheet_ids:
+    # the patches are built from the worksteps that were just pushed and submitted concurrently
+    patches = [
+        (
+            worksheet.id,
+            patch_workstep(
+                pushed_workstep_data(worksheet, workbooks_api, workbook_id),
+                histogram_items.get(worksheet.name),
+            ),
+        )
+        for worksheet in new_worksheets
+    ]
+    with ThreadPoolExecutor(max_workers=WORKSTEP_WORKERS) as executor:
+        for future in [
+            executor.submit(
+                workbooks_api.create_workstep,
+                workbook_id=workbook_id,
+                worksheet_id=worksheet_id,
+                body={"data": json.dumps(worksheet_data_dict)},
+            )
+            for worksheet_id, worksheet_data_dict in patches
+        ]:
+            future.result()
+    return {worksheet.name: worksheet.id for worksheet in new_worksheets}
+
+
+def histogram_worksheets(histogram_dict, summary=False):
+    # histograms by worksheet name, the summary layout puts SUMMARY_SIGNALS of them on a worksheet
+    if not summary:
+        return {
+            worksheet_name: [("Histogram", histogram_id)]
+            for worksheet_name, histogram_id in histogram_dict.items()
+        }
+    histograms = list(histogram_dict.items())
+    return {
+        f"Histogram Summary {i // SUMMARY_SIGNALS + 1}": histograms[
+            i : i + SUMMARY_SIGNALS
+        ]
+        for i in range(0, len(histograms), SUMMARY_SIGNALS)
+    }
+
+
+def signal_index(name, signal_names):
+    # items belong to the signal their name starts with, the apply to condition to the first
+    for i, signal_name in enumerate(signal_names):
+        if name == signal_name or name.startswith(f"{signal_name}: "):
+            return i
+    return 0
+
+
+def axis_group(index):
+    # axis groups are lettered like spreadsheet columns, A to Z then AA
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def existing_worksheet_ids(workbooks_api, workbook_id, worksheet_names):
+    # worksheets are listed without their worksteps, a page at a time
+    worksheet_ids = []
+    offset = 0
+    while True:
+        worksheets = workbooks_api.get_worksheets(
+            workbook_id=workbook_id, offset=offset, limit=WORKSHEET_PAGE_SIZE
+        ).worksheets
+        worksheet_ids += [
+            worksheet.id
+            for worksheet in worksheets
+            if worksheet.name in worksheet_names
+        ]
+        if len(worksheets) < WORKSHEET_PAGE_SIZE:
+            return worksheet_ids
+        offset += WORKSHEET_PAGE_SIZE
+
+
+def pushed_workstep_data(worksheet, workbooks_api, workbook_id):
+    # the workbook object holds the workstep it pushed, the server is only asked when it does not
+    try:
+        data = copy.deepcopy(worksheet.current_workstep().data)
+        data["state"]["stores"]
+        return data
+    except Exception:
         workstep_id = (
-            workbooks_api.get_worksheet(workbook_id=workbook_id, worksheet_id=worksheet)
+            workbooks_api.get_worksheet(
+                workbook_id=workbook_id, worksheet_id=worksheet.id
+            )
             .to_dict()["workstep"]
             .split("/")
             .pop(-1)
         )
         worksheet_data = workbooks_api.get_workstep(
-            workbook_id=workbook_id, worksheet_id=worksheet, workstep_id=workstep_id
+            workbook_id=workbook_id, worksheet_id=worksheet.id, workstep_id=workstep_id
         ).to_dict()["data"]
-        worksheet_data_dict = json.loads(worksheet_data)
-        try:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"]
-        except:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"] = {
-                "labelDisplayConfiguration": {
-                    "name": "off",
-                    "asset": "off",
-                    "assetPathLevels": 1,
-                    "unitOfMeasure": "off",
-                    "custom": "off",
-                    "customLabels": [],
-                },
-                "showCapsuleLaneLabels": False,
-            }
-        try:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"][
-                "labelDisplayConfiguration"
-            ]
-        except:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"][
-                "labelDisplayConfiguration"
-            ] = {
+        return json.loads(worksheet_data)
+
+
+def patch_workstep(worksheet_data_dict, histograms=None):
+    try:
+        worksheet_data_dict["state"]["stores"]["sqTrendStore"]
+    except:
+        worksheet_data_dict["state"]["stores"]["sqTrendStore"] = {
+            "labelDisplayConfiguration": {
                 "name": "off",
                 "asset": "off",
                 "assetPathLevels": 1,
                 "unitOfMeasure": "off",
                 "custom": "off",
                 "customLabels": [],
-            }
-        try:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"][
-                "showCapsuleLaneLabels"
-            ]
-        except:
-            worksheet_data_dict["state"]["stores"]["sqTrendStore"][
-                "showCapsuleLaneLabels"
-            ] = False
+            },
+            "showCapsuleLaneLabels": False,
+        }
+    try:
         worksheet_data_dict["state"]["stores"]["sqTrendStore"][
             "labelDisplayConfiguration"
-        ]["name"] = "lane"
+        ]
+    except:
         worksheet_data_dict["state"]["stores"]["sqTrendStore"][
             "labelDisplayConfiguration"
-        ]["unitOfMeasure"] = "axis"
+        ] = {
+            "name": "off",
+            "asset": "off",
+            "assetPathLevels": 1,
+            "unitOfMeasure": "off",
+            "custom": "off",
+            "customLabels": [],
+        }
+    try:
+        worksheet_data_dict["state"]["stores"]["sqTrendStore"]["showCapsuleLaneLabels"]
+    except:
         worksheet_data_dict["state"]["stores"]["sqTrendStore"][
             "showCapsuleLaneLabels"
-        ] = True
-
+        ] = False
+    worksheet_data_dict["state"]["stores"]["sqTrendStore"]["labelDisplayConfiguration"][
+        "name"
+    ] = "lane"
+    worksheet_data_dict["state"]["stores"]["sqTrendStore"]["labelDisplayConfiguration"][
+        "unitOfMeasure"
+    ] = "axis"
+    worksheet_data_dict["state"]["stores"]["sqTrendStore"][
+        "showCapsuleLaneLabels"
+    ] = True
+    if histograms:
+        worksheet_data_dict["state"]["stores"]["sqTrendTableStore"] = {
+            "items": [
+                {
+                    "autoDisabled": False,
+                    "stack": False,
+                    "id": histogram_id,
+                    "name": histogram_name,
+                    "selected": False,
+                    "color": INPUT_COLOR,
+                    "binConfig": {},
+                }
+                for histogram_name, histogram_id in histograms
+            ]
+        }
     return worksheet_data_dict
 
 
-def format_histogram_worksheet(histogram_id, signal_name, URL, workbook_id):
-    workbooks_api = sdk.WorkbooksApi(spy.client)
-
-    histogram = spy.search(
-        {"Scoped To": workbook_id, "Name": f"{signal_name}: Mean"},
-        quiet=True,
-        all_properties=True,
-    )
-    push_histogram = spy.push(
-        metadata=histogram,
-        workbook=workbook_id,
-        worksheet=f"{signal_name} Histogram",
-        errors="catalog",
-        quiet=True,
-    )
-    wb = spy.workbooks.pull(URL, include_inventory=False, quiet=True)
-
-    try:
-        ws = wb[0].worksheets[
-            f"My Folder >> {wb[0]['Name']} >> {signal_name} Histogram"
-        ]
-    except:
-        for sheet in wb[0].worksheets:
-            if sheet["Name"] == f"{signal_name} Histogram":
-                ws = sheet
-
-    ws.display_items = pd.DataFrame(columns=["Name", "Type", "ID"])
-    spy.workbooks.push(wb, include_inventory=False, quiet=True)
-    worksheet_url = push_histogram.spy.workbook_url
-    histogram_worksheet_id = worksheet_url.split("/").pop(-1)
-    workstep_id = (
-        workbooks_api.get_worksheet(
-            workbook_id=workbook_id, worksheet_id=histogram_worksheet_id
-        )
-        .to_dict()["workstep"]
-        .split("/")
-        .pop(-1)
-    )
-    worksheet_data = workbooks_api.get_workstep(
-        workbook_id=workbook_id,
-        worksheet_id=histogram_worksheet_id,
-        workstep_id=workstep_id,
-    ).to_dict()["data"]
-    worksheet_data_dict = json.loads(worksheet_data)
-    try:
-        worksheet_data_dict["state"]["stores"]["sqTrendTableStore"]
-    except:
-        worksheet_data_dict["state"]["stores"]["sqTrendTableStore"] = {"items": []}
-    worksheet_data_dict["state"]["stores"]["sqTrendTableStore"] = {
-        "items": [
-            {
-                "autoDisabled": False,
-                "stack": False,
-                "id": histogram_id,
-                "name": "Histogram",
-                "selected": False,
-                "color": "#4055a3",
-                "binConfig": {},
-            }
-        ]
-    }
-    replaced_worksheet_data = json.dumps(worksheet_data_dict)
-    workbooks_api.create_workstep(
-        workbook_id=workbook_id,
-        worksheet_id=histogram_worksheet_id,
-        body={"data": replaced_worksheet_data},
-    )
+def item_color(name):
+    for pattern, color in ITEM_COLORS:
+        if re.search(pattern, name):
+            return color
+    return INPUT_COLOR
@@ -1,8 +1,15 @@
 from seeq import spy
 from seeq import sdk
+from seeq.sdk.rest import ApiException
 import json
+import threading
+import urllib3
 from datetime import datetime
 import pandas as pd
+from spc_accelerator.catalog import ItemCatalog
+
+# errors of a server call that the capsule property lookups fall back from, anything else is a bug
+API_ERRORS = (ApiException, urllib3.exceptions.HTTPError)
 
 
 def pull_worksheet_data(URL, workbook_id, worksheet_id):
@@ -13,7 +20,9 @@ def pull_worksheet_data(URL, workbook_id, worksheet_id):
         signals = worksheet_items[worksheet_items["Type"].str.contains("Signal")]
         signal_list = signals["Name"].to_list()
         signals_with_properties = spy.search(
-            signals, include_properties=["Interpolation Method"], quiet=True
+            signals,
+            include_properties=["Interpolation Method", "Value Unit Of Measure"],
+            quiet=True,
         )
         conditions = worksheet_items[worksheet_items["Type"].str.contains("Condition")]
         condition_list = conditions["Name"].to_list()
@@ -41,6 +50,7 @@ def pull_worksheet_data(URL, workbook_id, worksheet_id):
             end_time,
             signals_with_properties,
             conditions,
+            ItemCatalog(pd.concat([signals_with_properties, conditions])),
         )
     except:
         worksheet_items = pd.DataFrame()
@@ -65,4 +75,128 @@ def pull_worksheet_data(URL, workbook_id, worksheet_id):
         start_time = datetime.fromtimestamp(start / 1000).astimezone()
         end_time = datetime.fromtimestamp(end / 1000).astimezone()
 
-        return signal_list, condition_list, start_time, end_time, signals, conditions
+        return (
+            signal_list,
+            condition_list,
+            start_time,
+            end_time,
+            signals,
+            conditions,
+            ItemCatalog(),
+        )
+
+
+class CapsuleProperties:
+    """
+    Capsule property names and values of conditions, cached per condition and training
+    window. Property names come from a bounded sample of capsules, the values and their
+    capsule counts are only streamed when the mean formula needs them.
+    """
+
+    SAMPLE_SIZE = 100
+    PAGE_SIZE = 10000
+    CAPSULE_COLUMNS = [
+        "Condition",
+        "Capsule Start",
+        "Capsule End",
+        "Capsule Is Uncertain",
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._window = None
+        self._names = {}
+        self._values = {}
+
+    def _check_window(self, start, end):
+        # the cache only holds the current training window, changing it invalidates everything
+        if self._window != (start, end):
+            self._window = (start, end)
+            self._names = {}
+            self._values = {}
+
+    def names(self, condition_df, start, end):
+        condition_id = condition_df["ID"].iloc[0]
+        with self._lock:
+            self._check_window(start, end)
+            if condition_id in self._values:
+                return list(self._values[condition_id])
+            if condition_id in self._names:
+                return list(self._names[condition_id])
+        try:
+            capsules = (
+                sdk.ConditionsApi(spy.client)
+                .get_capsules(
+                    id=condition_id,
+                    start=start.isoformat(),
+                    end=end.isoformat(),
+                    limit=CapsuleProperties.SAMPLE_SIZE,
+                )
+                .capsules
+            )
+            names = list(
+                dict.fromkeys(
+                    prop.name for capsule in capsules for prop in capsule.properties
+                )
+            )
+        except API_ERRORS:
+            names = list(self.counts(condition_df, start, end))
+        with self._lock:
+            self._check_window(start, end)
+            self._names[condition_id] = names
+        return list(names)
+
+    def values(self, condition_df, property_name, start, end, min_capsules=1):
+        # grades with fewer capsules than min_capsules are dropped, too little data for limits
+        return [
+            value
+            for value, count in self.counts(condition_df, start, end)
+            .get(property_name, {})
+            .items()
+            if count >= min_capsules
+        ]
+
+    def counts(self, condition_df, start, end):
+        condition_id = condition_df["ID"].iloc[0]
+        with self._lock:
+            self._check_window(start, end)
+            if condition_id in self._values:
+                return self._values[condition_id]
+        try:
+            counts = self._stream_counts(condition_id, start, end)
+        except API_ERRORS:
+            capsules = spy.pull(condition_df, start=start, end=end, quiet=True)
+            counts = {
+                column: capsules[column].value_counts(sort=False).to_dict()
+                for column in capsules.columns
+                if column not in CapsuleProperties.CAPSULE_COLUMNS
+            }
+        with self._lock:
+            self._check_window(start, end)
+            self._values[condition_id] = counts
+        return counts
+
+    def _stream_counts(self, condition_id, start, end):
+        # capsules are read a page at a time and only the count per property value is kept, the
+        # next page is requested with the continuation token of the previous one
+        conditions_api = sdk.ConditionsApi(spy.client)
+        counts = {}
+        page_token = {}
+        while True:
+            page = conditions_api.get_capsules(
+                id=condition_id,
+                start=start.isoformat(),
+                end=end.isoformat(),
+                limit=CapsuleProperties.PAGE_SIZE,
+                **page_token,
+            )
+            for capsule in page.capsules:
+                for prop in capsule.properties:
+                    property_counts = counts.setdefault(prop.name, {})
+                    property_counts[prop.value] = property_counts.get(prop.value, 0) + 1
+            if not page.continuation_token or not page.capsules:
+                return counts
+            page_token = {"continuation_token": page.continuation_token}
+
+
+capsule_properties = CapsuleProperties()
@@ -5,3 +5,15 @@ here = os.path.dirname(__file__)
 sys.path.append(os.path.join(here, "../.."))
 
 from build.fixtures.common import *
+
+# session logins of the system and end-to-end tests, with the fixtures only they depend on
+LOGIN_FIXTURES = ["login_spy", "login_playwright", "api_request_context", "playwright"]
+
+
+def pytest_collection_modifyitems(items):
+    # unit tests do not use Seeq Server, so they run without the autouse logins
+    for item in items:
+        if item.get_closest_marker("unit"):
+            for name in LOGIN_FIXTURES:
+                if name in item.fixturenames:
+                    item.fixturenames.remove(name)
@@ -209,6 +209,7 @@ def test_spc_accelerator_object_created_successfully(spc_accelerator_testing):
     assert isinstance(spc_accelerator.nelson_runrules, v.Checkbox)
     assert isinstance(spc_accelerator.histogram, v.Checkbox)
     assert isinstance(spc_accelerator.button, v.Btn)
+    assert isinstance(spc_accelerator.cancel_button, v.Btn)
     assert isinstance(spc_accelerator.workbook_button, v.Btn)
     assert isinstance(spc_accelerator.error, v.Alert)
     assert isinstance(spc_accelerator.success, v.Alert)
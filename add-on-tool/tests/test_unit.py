@@ -0,0 +1,1373 @@
+import numpy as np
+import pandas as pd
+import asyncio
+import inspect
+import json
+import pathlib
+import pytest
+import re
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+
+from spc_accelerator.backend import (
+    CONTENT_HASH_PROPERTY,
+    LIMIT_NAMES,
+    create_limit_signals,
+    create_control_chart,
+    create_frozen_formula_strings,
+    create_grouped_formula_strings,
+    create_mean_and_stddev_signals,
+    selected_limits,
+    selected_rule_sets,
+    split_unchanged_items,
+    stamp_content_hash,
+)
+from spc_accelerator import backend, utils
+from spc_accelerator.app import SPCAccelerator
+from spc_accelerator.catalog import ItemCatalog
+from spc_accelerator.moments import MomentAccumulator
+from spc_accelerator.planner import RunCancelled, TaskGraph
+from spc_accelerator import registry, templates
+from spc_accelerator.templates import INPUT_COLOR, item_color
+
+signals = pd.DataFrame(
+    [
+        {
+            "Name": "Temperature",
+            "ID": "0EE0A1B2-0000-0000-0000-000000000001",
+            "Type": "StoredSignal",
+            "Interpolation Method": "Linear",
+        }
+    ]
+)
+conditions = pd.DataFrame(
+    [
+        {
+            "Name": "Days",
+            "ID": "0EE0A1B2-0000-0000-0000-000000000002",
+            "Type": "StoredCondition",
+        }
+    ]
+)
+
+catalog = ItemCatalog(pd.concat([signals, conditions]))
+
+
+def widget(v_model):
+    return SimpleNamespace(v_model=v_model)
+
+
+@pytest.mark.unit
+def test_limits_reference_unpushed_mean_by_name():
+    mean_stddev_signal_df = create_mean_and_stddev_signals(
+        "$inputsignal.average($capsule)",
+        "$inputsignal.stddev($capsule)",
+        "Temperature",
+        widget([]),
+        catalog,
+        widget([]),
+    )
+    limits_df = create_limit_signals(mean_stddev_signal_df, "Temperature")
+
+    # limits reference the unpushed mean row by name and type so it resolves within the batch
+    mean_parameter = limits_df.at[0, "Formula Parameters"]["$Mean"]
+    assert mean_parameter[["Name", "Type"]].iloc[0].to_list() == [
+        "Temperature: Mean",
+        "Signal",
+    ]
+
+
+def mean_stddev_items(capsule_start="2024-01-01T00:00:00"):
+    return stamp_content_hash(
+        create_mean_and_stddev_signals(
+            "$inputsignal.average($capsule)",
+            "$inputsignal.stddev($capsule)",
+            "Temperature",
+            widget([]),
+            catalog,
+            widget([]),
+        ),
+        capsule_start,
+        "2024-02-01T00:00:00",
+    )
+
+
+@pytest.mark.unit
+def test_content_hash_depends_on_training_window():
+    first = mean_stddev_items()[CONTENT_HASH_PROPERTY].to_list()
+    second = mean_stddev_items()[CONTENT_HASH_PROPERTY].to_list()
+    moved = mean_stddev_items("2024-01-02T00:00:00")[CONTENT_HASH_PROPERTY].to_list()
+
+    assert first == second
+    assert first[0] != first[1]
+    assert set(first).isdisjoint(moved)
+
+
+@pytest.mark.unit
+def test_limit_hash_does_not_depend_on_mean_being_pushed():
+    mean_stddev_df = mean_stddev_items()
+    pushed_df = mean_stddev_df.assign(ID=["mean-id", "stddev-id"])
+    window = ("2024-01-01T00:00:00", "2024-02-01T00:00:00")
+
+    unpushed_limits = stamp_content_hash(
+        create_limit_signals(mean_stddev_df, "Temperature"), *window
+    )
+    pushed_limits = stamp_content_hash(
+        create_limit_signals(pushed_df, "Temperature"), *window
+    )
+
+    assert (
+        unpushed_limits[CONTENT_HASH_PROPERTY].to_list()
+        == pushed_limits[CONTENT_HASH_PROPERTY].to_list()
+    )
+
+
+@pytest.mark.unit
+def test_split_unchanged_items_resolves_references_to_skipped_items():
+    mean_stddev_df = mean_stddev_items()
+    limits_df = stamp_content_hash(
+        create_limit_signals(mean_stddev_df, "Temperature"),
+        "2024-01-01T00:00:00",
+        "2024-02-01T00:00:00",
+    )
+    items_df = pd.concat([mean_stddev_df, limits_df], ignore_index=True)
+    existing_items = {
+        ("Temperature: Mean", items_df.at[0, CONTENT_HASH_PROPERTY]): "mean-id",
+        ("Temperature: +1 Sigma", items_df.at[2, CONTENT_HASH_PROPERTY]): "limit-id",
+        ("Temperature: -1 Sigma", "outdated"): "other-id",
+    }
+
+    changed_df, unchanged_df = split_unchanged_items(items_df, existing_items)
+
+    assert unchanged_df["ID"].to_list() == ["mean-id", "limit-id"]
+    limit_parameters = changed_df.set_index("Name")["Formula Parameters"]
+    parameters = limit_parameters["Temperature: -1 Sigma"]
+    assert parameters["$Mean"] == "mean-id"
+    assert isinstance(parameters["$StandardDeviation"], pd.DataFrame)
+
+
+def control_chart_instance(**widgets):
+    instance = SimpleNamespace(
+        URL="",
+        workbook_id="workbook",
+        worksheet_id="worksheet",
+        signal_list=["Temperature"],
+        signals=signals,
+        condition_list=["Days"],
+        conditions=conditions,
+        catalog=catalog,
+        start_time=None,
+        end_time=None,
+        input_signal=widget(["Temperature"]),
+        signal_interpolation=widget(40),
+        interpolation_units=widget("hour(s)"),
+        capsule_property=widget([]),
+        start_select=SimpleNamespace(value=datetime(2024, 1, 1)),
+        end_select=SimpleNamespace(value=datetime(2024, 2, 1)),
+        apply_to_condition=widget([]),
+        control_chart=widget(True),
+        we_runrules=widget(True),
+        we_rules=widget([1, 2, 3, 4]),
+        nelson_runrules=widget(False),
+        nelson_rules=widget([1, 2, 3, 4, 5, 6, 7, 8]),
+        histogram=widget(True),
+        button=None,
+        workbook_button=None,
+        error=None,
+        success=None,
+        input_condition=widget([]),
+    )
+    for name, value in widgets.items():
+        setattr(instance, name, value)
+    return instance
+
+
+@pytest.mark.unit
+def test_dry_run_plans_items_and_worksheets():
+    instance = control_chart_instance()
+
+    plan = create_control_chart(instance, dry_run=True)
+
+    items = {item["Name"]: item for item in plan["items"]}
+    assert len(items) == 12
+    assert items["Temperature: +1 Sigma"]["Formula Parameters"]["$Mean"] == [
+        "Temperature: Mean",
+        "Signal",
+    ]
+    assert plan["worksheets"]["Temperature Control Chart"][-1] == signals.at[0, "ID"]
+    assert len(plan["worksheets"]["Temperature Western Electric Run Rules"]) == 12
+    assert "Temperature Histogram" in plan["worksheets"]
+    assert plan["errors"] == {}
+    assert "Temperature: Nelson Run Rule 1" not in plan["timings"]
+
+
+@pytest.mark.unit
+def test_catalog_indexes_items_by_name_and_id():
+    catalog = ItemCatalog(pd.concat([signals, conditions]))
+    catalog.add(
+        pd.DataFrame([{"Name": "Temperature: Mean", "ID": "mean-id", "Type": "Signal"}])
+    )
+
+    assert catalog.item("Temperature")["ID"].iloc[0] == signals.at[0, "ID"]
+    assert catalog.interpolation_method("Temperature") == "Linear"
+    assert catalog.type("Days") == "StoredCondition"
+    assert catalog.item("Missing").empty
+    assert catalog.item([]).empty
+    assert catalog.items_by_id(["mean-id", conditions.at[0, "ID"]])[
+        "Name"
+    ].to_list() == ["Temperature: Mean", "Days"]
+
+
+@pytest.mark.unit
+def test_task_graph_passes_dependency_results():
+    graph = TaskGraph()
+    graph.add("Mean", lambda: 2, group="Temperature")
+    graph.add("Limit", lambda mean: mean * 3, ["Mean"], group="Temperature")
+    graph.add("Rule", lambda mean, limit: mean + limit, ["Mean", "Limit"])
+    graph.run(4)
+
+    assert graph.result("Rule") == 8
+    assert graph.graph()["Rule"] == ["Mean", "Limit"]
+    assert set(graph.timings()) == {"Mean", "Limit", "Rule"}
+
+
+@pytest.mark.unit
+def test_task_graph_skips_dependents_of_failed_and_disabled_nodes():
+    def fail():
+        raise ValueError("no data")
+
+    progress = []
+    graph = TaskGraph()
+    graph.add("Temperature: Mean", lambda: 1, group="Temperature")
+    graph.add("Pressure: Mean", fail, group="Pressure")
+    graph.add(
+        "Pressure: Limit", lambda mean: mean, ["Pressure: Mean"], group="Pressure"
+    )
+    graph.add("Histogram", lambda: 1, enabled=False)
+    graph.add("Format", lambda histogram: histogram, ["Histogram"])
+    graph.add("Template", lambda: "done", after=["Pressure: Limit", "Format"])
+    graph.run(4, progress.append)
+
+    assert graph.status("Pressure: Limit") == "skipped"
+    assert graph.status("Format") == "skipped"
+    assert graph.result("Template") == "done"
+    assert graph.group_errors("Pressure") == ["no data"]
+    assert graph.group_incomplete("Pressure")
+    assert not graph.group_incomplete("Temperature")
+    assert sorted(progress) == ["Pressure: Mean", "Temperature: Mean", "Template"]
+
+
+@pytest.mark.unit
+def test_task_graph_detects_cycles():
+    graph = TaskGraph()
+    graph.add("A", lambda b: b, ["B"])
+    graph.add("B", lambda a: a, ["A"])
+
+    with pytest.raises(ValueError):
+        graph.run()
+
+
+@pytest.mark.unit
+def test_moment_accumulator_matches_pandas_over_chunks_and_merges():
+    samples = pd.Series(np.random.default_rng(7).normal(1e6, 3.5, 10001))
+    samples[[5, 500, 9000]] = np.nan
+
+    chunked = MomentAccumulator()
+    for chunk in np.array_split(samples.to_numpy(), 13):
+        chunked.add(chunk)
+    merged = (
+        MomentAccumulator()
+        .add(samples[:4000])
+        .merge(MomentAccumulator().add(samples[4000:]))
+    )
+
+    for moments in [chunked, merged]:
+        assert moments.count == samples.count()
+        assert moments.mean == pytest.approx(samples.mean(), rel=1e-12)
+        assert moments.std == pytest.approx(samples.std(), rel=1e-9)
+        assert moments.min == samples.min()
+        assert moments.max == samples.max()
+
+
+@pytest.mark.unit
+def test_moment_accumulator_handles_empty_and_single_samples():
+    moments = MomentAccumulator().add([]).merge(MomentAccumulator())
+    assert moments.count == 0
+    moments.add([np.nan, 2.0])
+    assert moments.count == 1
+    assert moments.mean == 2.0
+    assert np.isnan(moments.std)
+    assert np.isnan(pd.Series([2.0]).std())
+
+
+@pytest.mark.unit
+def test_capsule_properties_are_cached_per_window(monkeypatch):
+    pulls = []
+
+    def pull(items, start, end, quiet):
+        pulls.append((start, end))
+        return pd.DataFrame(
+            {
+                "Condition": ["Days"] * 3,
+                "Capsule Start": [start] * 3,
+                "Capsule End": [end] * 3,
+                "Grade": ["A", "B", "A"],
+            }
+        )
+
+    def get_capsules(**kwargs):
+        raise utils.ApiException(status=503)
+
+    monkeypatch.setattr(utils.spy, "pull", pull)
+    monkeypatch.setattr(
+        utils.sdk,
+        "ConditionsApi",
+        lambda client: SimpleNamespace(get_capsules=get_capsules),
+    )
+    capsule_properties = utils.CapsuleProperties()
+    january = (datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert capsule_properties.values(conditions, "Grade", *january) == ["A", "B"]
+    assert capsule_properties.values(conditions, "Grade", *january, 2) == ["A"]
+    assert capsule_properties.names(conditions, *january) == ["Grade"]
+    assert len(pulls) == 1
+    capsule_properties.values(conditions, "Grade", datetime(2024, 1, 2), january[1])
+    assert len(pulls) == 2
+
+
+@pytest.mark.unit
+def test_capsule_property_counts_page_with_the_continuation_token(monkeypatch):
+    requests = []
+
+    def capsule(grade):
+        return SimpleNamespace(properties=[SimpleNamespace(name="Grade", value=grade)])
+
+    def get_capsules(**kwargs):
+        requests.append(kwargs)
+        if "continuation_token" not in kwargs:
+            return SimpleNamespace(
+                capsules=[capsule("A"), capsule("B")], continuation_token="page-2"
+            )
+        return SimpleNamespace(capsules=[capsule("A")], continuation_token=None)
+
+    def pull(*args, **kwargs):
+        raise AssertionError("the streamed counts must not fall back to spy.pull")
+
+    monkeypatch.setattr(utils.spy, "pull", pull)
+    monkeypatch.setattr(
+        utils.sdk,
+        "ConditionsApi",
+        lambda client: SimpleNamespace(get_capsules=get_capsules),
+    )
+    capsule_properties = utils.CapsuleProperties()
+    january = (datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert capsule_properties.counts(conditions, *january) == {
+        "Grade": {"A": 2, "B": 1}
+    }
+    assert [request.get("continuation_token") for request in requests] == [
+        None,
+        "page-2",
+    ]
+
+
+@pytest.mark.unit
+def test_grouped_formula_has_one_line_per_grade():
+    # the formula grows with the grades, only their statistics are computed once
+    statistics = {f"G{grade}": (grade, grade / 10) for grade in range(400)}
+    statistics[7] = (1.5, 0.5)
+
+    average_formula, stddev_formula = create_grouped_formula_strings(
+        statistics, widget("Grade")
+    )
+
+    assert average_formula.count("\n") == len(statistics) + 1
+    assert ".splice(1.5, $applytocondition.keep('Grade', isMatch(7)))" in (
+        average_formula
+    )
+    assert ".splice(39.9, $applytocondition.keep('Grade', isMatch('G399')))" in (
+        stddev_formula
+    )
+    assert "$inputsignal" not in average_formula
+
+
+@pytest.mark.unit
+def test_run_graph_options_are_keyword_only():
+    parameters = list(inspect.signature(backend.create_run_graph).parameters.values())
+
+    assert parameters[0].name == "signal_names"
+    assert all(p.kind == inspect.Parameter.KEYWORD_ONLY for p in parameters[1:])
+
+
+@pytest.mark.unit
+def test_dry_run_marks_frozen_limits_as_computed_at_run_time(monkeypatch):
+    def run_formula(**kwargs):
+        raise AssertionError("a plan reads nothing from the server")
+
+    monkeypatch.setattr(backend, "formulaAPI", SimpleNamespace(run_formula=run_formula))
+    instance = control_chart_instance()
+
+    plan = create_control_chart(instance, dry_run=True, freeze_limits=True)
+
+    items = {item["Name"]: item for item in plan["items"]}
+    for name in ["Temperature: Mean", "Temperature: Standard Deviation"]:
+        assert items[name]["Formula"] == backend.COMPUTED_AT_RUN_TIME
+        assert items[name][CONTENT_HASH_PROPERTY] is None
+    assert "average()" not in items["Temperature: Mean"]["Formula"]
+    assert items["Temperature: +1 Sigma"][CONTENT_HASH_PROPERTY] is not None
+    assert "Training Statistics" in plan["timings"]
+    assert "Mean Formula" not in plan["timings"]
+    assert plan["errors"] == {}
+
+
+@pytest.mark.unit
+def test_dry_run_shares_grade_conditions_between_signals():
+    two_signals = pd.concat(
+        [
+            signals,
+            signals.assign(Name="Pressure", ID="0EE0A1B2-0000-0000-0000-000000000003"),
+        ]
+    )
+    instance = control_chart_instance(
+        signals=two_signals,
+        catalog=ItemCatalog(pd.concat([two_signals, conditions])),
+        input_signal=widget(["Temperature", "Pressure"]),
+        capsule_property=widget("Grade"),
+        apply_to_condition=widget("Days"),
+        we_runrules=widget(False),
+        histogram=widget(False),
+        input_condition=widget("Days"),
+    )
+
+    plan = create_control_chart(instance, dry_run=True, property_values=["A", 7])
+
+    items = {item["Name"]: item for item in plan["items"]}
+    assert items["Days: Grade A In Control (Days)"]["Type"] == "Condition"
+    assert "Days: Grade 7" in items
+    for signal_name in ["Temperature", "Pressure"]:
+        mean = items[f"{signal_name}: Mean"]
+        assert mean["Formula Parameters"]["$a7_applyto"] == [
+            "Days: Grade 7",
+            "Condition",
+        ]
+        assert "$A_average = $inputsignal.remove(not $A)" in mean["Formula"]
+        assert "keep(" not in mean["Formula"]
+
+    # the in control conditions of another input condition are separate items
+    shift_conditions, _ = backend.create_grade_conditions(
+        ["A"], widget("Grade"), widget("Shifts"), widget("Days"), catalog
+    )
+    assert shift_conditions["Name"].to_list() == [
+        "Days: Grade A In Control (Shifts)",
+        "Days: Grade A",
+    ]
+
+
+@pytest.mark.unit
+def test_frozen_formulas_are_constants():
+    average_formula, stddev_formula = create_frozen_formula_strings(-1.5, 0.25, True)
+
+    assert average_formula.endswith("\n-1.5.toSignal().within($applytocondition)")
+    assert stddev_formula.endswith("\n0.25.toSignal().within($applytocondition)")
+    assert "$inputsignal" not in average_formula + stddev_formula
+
+
+@pytest.mark.unit
+def test_training_statistics_read_named_columns_and_skip_non_finite_grades(
+    monkeypatch,
+):
+    calls = []
+    responses = []
+
+    def run_formula(**kwargs):
+        calls.append(kwargs)
+        return responses.pop(0)
+
+    def table(headers, data):
+        return SimpleNamespace(
+            table=SimpleNamespace(
+                headers=[SimpleNamespace(name=header) for header in headers],
+                data=data,
+            )
+        )
+
+    monkeypatch.setattr(backend, "formulaAPI", SimpleNamespace(run_formula=run_formula))
+    headers = ["Grade", "signal0 Mean", "signal0 StdDev"]
+    responses.append(table(headers, [["A", 10.0, 2.0], ["B", 4.0, float("nan")]]))
+    window = ("2024-01-01T00:00:00", "2024-02-01T00:00:00")
+
+    statistics = backend.training_statistics(
+        {"Temperature": "temperature-id"}, "days", "days", "Grade", *window
+    )
+
+    # the grade with a single sample has no standard deviation, so it has no limits
+    assert statistics == {"Temperature": {"A": (10.0, 2.0)}}
+    assert "'signal0 StdDev'" in calls[0]["formula"]
+
+    responses.append(table(["Grade", "signal0 Mean"], [["A", 10.0]]))
+    with pytest.raises(ValueError, match="signal0 StdDev"):
+        backend.training_statistics(
+            {"Temperature": "temperature-id"}, "days", "days", "Grade", *window
+        )
+
+    properties = [
+        SimpleNamespace(name="signal0 Mean", value=float("nan")),
+        SimpleNamespace(name="signal0 StdDev", value=float("nan")),
+    ]
+    responses.append(
+        SimpleNamespace(
+            capsules=SimpleNamespace(capsules=[SimpleNamespace(properties=properties)])
+        )
+    )
+    assert (
+        backend.training_statistics(
+            {"Temperature": "temperature-id"}, None, None, None, *window
+        )
+        == {}
+    )
+
+
+@pytest.mark.unit
+def test_frozen_formulas_keep_the_signal_units():
+    average_formula, _ = create_frozen_formula_strings(-1.5, 0.25, False, "°F")
+    assert average_formula.endswith("\n-1.5.toSignal().setUnits('°F')")
+    grouped_average, _ = create_grouped_formula_strings(
+        {"A": (1.5, 0.5), "B": (2.0, float("nan"))}, widget("Grade"), "bar"
+    )
+    assert grouped_average.endswith(".setUnits('bar').within($applytocondition)")
+    assert "isMatch('B')" not in grouped_average
+    with pytest.raises(ValueError):
+        create_frozen_formula_strings(float("nan"), 0.25, True)
+
+
+@pytest.mark.unit
+def test_lean_limits_only_plan_the_lines_in_use():
+    instance = control_chart_instance(
+        we_runrules=widget(False), histogram=widget(False)
+    )
+
+    plan = create_control_chart(instance, dry_run=True, lean_limits=True)
+
+    assert plan["worksheets"]["Temperature Control Chart"] == [
+        "Temperature: Mean",
+        "Temperature: +3 Sigma",
+        "Temperature: -3 Sigma",
+        signals.at[0, "ID"],
+    ]
+    assert [
+        item_color(name) for name in plan["worksheets"]["Temperature Control Chart"]
+    ] == [
+        "#00b050",
+        "#ff0000",
+        "#ff0000",
+        INPUT_COLOR,
+    ]
+    rule_sets = selected_rule_sets(
+        widget(True), widget(False), widget([1, 2, 3, 4]), widget([])
+    )
+    assert selected_limits(rule_sets, True) == LIMIT_NAMES
+
+
+@pytest.mark.unit
+def test_combined_rules_plan_one_condition_per_rule_set():
+    instance = control_chart_instance(nelson_runrules=widget(True))
+
+    plan = create_control_chart(instance, dry_run=True, combined_rules=True)
+
+    items = {item["Name"]: item for item in plan["items"]}
+    assert not any("Run Rule " in name for name in items)
+    nelson_rules = items["Temperature: Nelson Run Rules"]
+    assert "NelsonRunRules_AllRules($mean, $minus1sd" in nelson_rules["Formula"]
+    assert nelson_rules["Formula Parameters"]["$plus3sd"] == [
+        "Temperature: +3 Sigma",
+        "Signal",
+    ]
+    assert plan["worksheets"]["Temperature Western Electric Run Rules"][-1] == (
+        "Temperature: Western Electric Run Rules"
+    )
+    assert item_color("Temperature: Western Electric Run Rules") == "#ff0000"
+
+
+def expanded_formula(formula, variable=None):
+    # the final expression of a formula, or one of its variables, with every variable replaced
+    # by its definition, so
+    # formulas that compute the same thing through differently named variables compare equal.
+    # Comments and whitespace are dropped and Seeq function names are not case sensitive
+    statements = []
+    for line in formula.splitlines():
+        line = line.split("//")[0].strip()
+        if line.startswith(".") and statements:
+            statements[-1] += line
+        elif line:
+            statements.append(line)
+    variables = {}
+
+    def expand(expression):
+        return re.sub(
+            r"\$(\w+)",
+            lambda match: variables.get(match.group(1), match.group(0)),
+            expression,
+        )
+
+    for statement in statements[:-1]:
+        name, expression = re.fullmatch(r"\$(\w+)\s*=\s*(.*)", statement).groups()
+        variables[name] = expand(expression)
+    expression = variables[variable] if variable else expand(statements[-1])
+    return re.sub(r"\s+", "", expression).lower()
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("package", ["western-electric-run-rules", "nelson-run-rules"])
+def test_all_rules_is_the_union_of_the_rule_functions(package):
+    jsonnet = pytest.importorskip("_jsonnet")
+    path = pathlib.Path(__file__).parents[2] / package / "formula_package.jsonnet"
+    formula_package = json.loads(
+        jsonnet.evaluate_file(str(path), tla_vars={"suffix": "Test"})
+    )
+    functions = {
+        function["name"]: function for function in formula_package["functions"]
+    }
+    rules = sorted(name for name in functions if re.fullmatch(r"RunRule\d+", name))
+    all_rules = functions["AllRules"]["formula"]
+
+    # every rule of the combined condition evaluates to the body of its RunRule function
+    tagged = re.findall(
+        r"\$(\w+)\.setProperty\('Rule', 'Rule (\d+)'\)", all_rules.splitlines()[-1]
+    )
+    assert [f"RunRule{number}" for _, number in tagged] == rules
+    for variable, number in tagged:
+        assert expanded_formula(all_rules, variable) == expanded_formula(
+            functions[f"RunRule{number}"]["formula"]
+        )
+    # the shared intermediates are computed once
+    code = "\n".join(line.split("//")[0] for line in all_rules.splitlines())
+    for pattern in [
+        r"\$\w+\.toStep\([^)]*\)",
+        r"\$\w+\.toCapsules\(\)",
+        r"\$\w+\.toDiscrete\(\)",
+        r"\$\w+\.toCapsulesByCount\([^)]*\)",
+        r"\(\$\w+ [<>]=? \$\w+\)",
+    ]:
+        calls = [re.sub(r"\s+", "", call) for call in re.findall(pattern, code)]
+        assert len(calls) == len(set(calls)), calls
+    assert {
+        parameter["name"]
+        for name in rules
+        for parameter in functions[name]["parameters"]
+    } == {parameter["name"] for parameter in functions["AllRules"]["parameters"]}
+    assert len(rules) == len(
+        backend.RULE_LIMITS[
+            "Nelson" if package.startswith("nelson") else "Western Electric"
+        ]
+    )
+
+
+@pytest.mark.unit
+def test_only_picked_rules_are_planned():
+    instance = control_chart_instance(
+        we_rules=widget([1, 2]),
+        nelson_runrules=widget(True),
+        nelson_rules=widget([5]),
+        histogram=widget(False),
+    )
+
+    plan = create_control_chart(
+        instance, dry_run=True, lean_limits=True, combined_rules=True
+    )
+
+    # a partial selection keeps one condition per picked rule even in the combined mode
+    rule_names = [item["Name"] for item in plan["items"] if "Run Rule" in item["Name"]]
+    assert rule_names == [
+        "Temperature: Western Electric Run Rule 1",
+        "Temperature: Western Electric Run Rule 2",
+        "Temperature: Nelson Run Rule 5",
+    ]
+    assert "+1 Sigma" not in " ".join(item["Name"] for item in plan["items"])
+    assert plan["worksheets"]["Temperature Nelson Run Rules"][-1] == (
+        "Temperature: Nelson Run Rule 5"
+    )
+
+
+@pytest.mark.unit
+def test_scoped_rules_only_see_the_apply_to_condition():
+    instance = control_chart_instance(
+        input_condition=widget("Days"),
+        apply_to_condition=widget("Days"),
+        histogram=widget(False),
+    )
+
+    plan = create_control_chart(instance, dry_run=True, scope_rules=True)
+
+    rules = {item["Name"]: item for item in plan["items"] if "Run Rule" in item["Name"]}
+    assert len(rules) == 4
+    for rule in rules.values():
+        assert rule["Formula"].startswith("$inputsignal.within($applytocondition).")
+        assert rule["Formula Parameters"]["$applytocondition"] == conditions.at[0, "ID"]
+
+
+@pytest.mark.unit
+def test_episode_rules_wrap_the_rule_formulas():
+    instance = control_chart_instance(we_rules=widget([4]), histogram=widget(False))
+
+    plan = create_control_chart(instance, dry_run=True, episode_duration="1d")
+
+    rule = next(item for item in plan["items"] if "Run Rule" in item["Name"])
+    assert rule["Formula"] == (
+        "($inputsignal.WesternElectricRunRules_RunRule4($mean, 40h))"
+        ".WesternElectricRunRules_RuleEpisodes($inputsignal, 1d)"
+    )
+
+    # combined rules keep the rule of every episode
+    plan = create_control_chart(
+        control_chart_instance(histogram=widget(False)),
+        dry_run=True,
+        episode_duration="1d",
+        combined_rules=True,
+    )
+    rules = next(item for item in plan["items"] if item["Name"].endswith("Run Rules"))
+    assert rules["Formula"].startswith(
+        "$rules = $inputsignal.WesternElectricRunRules_AllRules("
+    )
+    for rule in range(1, 5):
+        assert (
+            f"$rules.keep('Rule', isMatch('Rule {rule}'))"
+            ".WesternElectricRunRules_RuleEpisodes($inputsignal, 1d)"
+            f".setProperty('Rule', 'Rule {rule}')"
+        ) in rules["Formula"]
+
+
+@pytest.mark.unit
+def test_histograms_share_one_statistics_formula(monkeypatch):
+    calls = []
+
+    def run_formula(**kwargs):
+        calls.append(("run_formula", kwargs))
+        properties = [
+            SimpleNamespace(name="Mean 0", value=10.0),
+            SimpleNamespace(name="StdDev 0", value=2.0),
+            SimpleNamespace(name="Count 0", value=100.0),
+        ]
+        return SimpleNamespace(
+            capsules=SimpleNamespace(capsules=[SimpleNamespace(properties=properties)])
+        )
+
+    def create_function(body):
+        calls.append(("create_function", body))
+        return SimpleNamespace(id=f"{body.name} ID")
+
+    monkeypatch.setattr(
+        backend,
+        "formulaAPI",
+        SimpleNamespace(run_formula=run_formula, create_function=create_function),
+    )
+    pressure = pd.DataFrame([{"Name": "Pressure", "ID": "pressure-id"}])
+
+    histogram_ids = backend.create_histograms(
+        {"Temperature": signals, "Pressure": pressure},
+        {"Temperature": "hash", "Pressure": "hash"},
+        "2024-01-01T00:00:00",
+        "2024-02-01T00:00:00",
+        widget([]),
+        catalog,
+        "workbook",
+        widget([]),
+    )
+
+    assert histogram_ids["Temperature"] == "Temperature Histogram ID"
+    assert isinstance(histogram_ids["Pressure"], ValueError)
+    statistics_calls = [
+        kwargs
+        for name, kwargs in calls
+        if name == "run_formula" and "formula" in kwargs
+    ]
+    assert len(statistics_calls) == 1
+    assert statistics_calls[0]["parameters"] == [
+        f"signal0={signals.at[0, 'ID']}",
+        "signal1=pressure-id",
+    ]
+    function = next(body for name, body in calls if name == "create_function")
+    assert [p.name for p in function.additional_properties] == [
+        "UIConfig",
+        CONTENT_HASH_PROPERTY,
+    ]
+
+
+@pytest.mark.unit
+def test_histograms_fall_back_to_samples_per_signal_on_api_errors(monkeypatch):
+    def window_statistics(signal_ids, start_time, end_time):
+        raise utils.ApiException(status=503)
+
+    def sample_statistics(signal_df, start_time, end_time):
+        if signal_df["Name"].iloc[0] == "Pressure":
+            raise utils.ApiException(status=500)
+        return 10.0, 2.0, 100
+
+    monkeypatch.setattr(backend, "window_statistics", window_statistics)
+    monkeypatch.setattr(backend, "sample_statistics", sample_statistics)
+    monkeypatch.setattr(
+        backend,
+        "formulaAPI",
+        SimpleNamespace(
+            create_function=lambda body: SimpleNamespace(id=f"{body.name} ID"),
+            run_formula=lambda **kwargs: None,
+        ),
+    )
+    pressure = pd.DataFrame([{"Name": "Pressure", "ID": "pressure-id"}])
+    arguments = (
+        {"Temperature": signals, "Pressure": pressure},
+        {"Temperature": "hash", "Pressure": "hash"},
+        "2024-01-01T00:00:00",
+        "2024-02-01T00:00:00",
+        widget([]),
+        catalog,
+        "workbook",
+        widget([]),
+    )
+
+    histogram_ids = backend.create_histograms(*arguments)
+
+    assert histogram_ids["Temperature"] == "Temperature Histogram ID"
+    assert isinstance(histogram_ids["Pressure"], utils.ApiException)
+
+    # anything but an API error is a bug, it is raised rather than hidden by the fallback
+    def broken_statistics(signal_ids, start_time, end_time):
+        raise TypeError("bad argument")
+
+    monkeypatch.setattr(backend, "window_statistics", broken_statistics)
+    with pytest.raises(TypeError):
+        backend.create_histograms(*arguments)
+
+
+class FakeWorkbook:
+    def __init__(self):
+        self.worksheets = {}
+
+    def worksheet(self, name):
+        data = {"state": {"stores": {}}}
+        return self.worksheets.setdefault(
+            name,
+            SimpleNamespace(
+                name=name,
+                id=f"{name} ID",
+                url=f"url/{name}",
+                current_workstep=lambda: SimpleNamespace(data=data),
+            ),
+        )
+
+
+class FakeWorkbooksApi:
+    def __init__(self):
+        self.worksteps = {}
+
+    def create_workstep(self, workbook_id, worksheet_id, body):
+        self.worksteps[worksheet_id] = body["data"]
+
+    def get_worksheets(self, workbook_id, offset, limit):
+        worksheets = [
+            SimpleNamespace(name=f"Sheet {i}", id=f"sheet-{i}") for i in range(1500)
+        ]
+        worksheets[1200].name = "Temperature Control Chart"
+        return SimpleNamespace(worksheets=worksheets[offset : offset + limit])
+
+
+@pytest.mark.unit
+def test_template_patches_worksteps_from_the_single_workbook_push(monkeypatch):
+    workbook = FakeWorkbook()
+    workbooks_api = FakeWorkbooksApi()
+    pushes = []
+    monkeypatch.setattr(
+        templates.spy,
+        "workbooks",
+        SimpleNamespace(
+            pull=lambda *args, **kwargs: [workbook],
+            push=lambda wb, **kwargs: pushes.append(wb),
+        ),
+    )
+    monkeypatch.setattr(templates.sdk, "WorkbooksApi", lambda client: workbooks_api)
+    instance = control_chart_instance()
+    workbook_button = SimpleNamespace(href=None)
+
+    templates.create_template(
+        "",
+        {"Temperature Control Chart": [signals.at[0, "ID"]]},
+        widget(True),
+        widget([]),
+        instance.start_select,
+        instance.end_select,
+        workbook_button,
+        "workbook",
+        {"Temperature Histogram": "histogram-id", "Pressure Histogram": "other-id"},
+        catalog,
+    )
+
+    assert len(pushes) == 1
+    assert list(workbook.worksheets) == [
+        "Temperature Control Chart",
+        "Temperature Histogram",
+        "Pressure Histogram",
+    ]
+    assert workbook_button.href == "url/Temperature Control Chart"
+    assert "histogram-id" in workbooks_api.worksteps["Temperature Histogram ID"]
+    assert "sqTrendTableStore" not in (
+        workbooks_api.worksteps["Temperature Control Chart ID"]
+    )
+    # the pushed worksteps are patched without reading them back from the server
+    assert len(workbooks_api.worksteps) == 3
+    assert '"name": "lane"' in workbooks_api.worksteps["Pressure Histogram ID"]
+
+
+@pytest.mark.unit
+def test_targeted_template_only_pulls_and_pushes_its_worksheets(monkeypatch):
+    workbook = FakeWorkbook()
+    calls = {}
+
+    def pull(URL, **kwargs):
+        calls["pull"] = kwargs
+        return [workbook]
+
+    def push(wb, **kwargs):
+        calls["push"] = kwargs
+
+    monkeypatch.setattr(
+        templates.spy, "workbooks", SimpleNamespace(pull=pull, push=push)
+    )
+    monkeypatch.setattr(
+        templates.sdk, "WorkbooksApi", lambda client: FakeWorkbooksApi()
+    )
+    instance = control_chart_instance()
+
+    templates.create_template(
+        "",
+        {"Temperature Control Chart": [signals.at[0, "ID"]]},
+        widget(True),
+        widget([]),
+        instance.start_select,
+        instance.end_select,
+        SimpleNamespace(href=None),
+        "workbook",
+        {"Temperature Histogram": "histogram-id"},
+        catalog,
+        targeted=True,
+    )
+
+    assert calls["pull"]["specific_worksheet_ids"] == ["sheet-1200"]
+    assert calls["push"]["specific_worksheet_ids"] == [
+        "Temperature Control Chart ID",
+        "Temperature Histogram ID",
+    ]
+
+
+@pytest.mark.unit
+def test_summary_worksheets_share_signals_with_a_lane_each(monkeypatch):
+    pressure = pd.DataFrame(
+        [
+            {
+                "Name": "Pressure",
+                "ID": "0EE0A1B2-0000-0000-0000-000000000003",
+                "Type": "StoredSignal",
+                "Interpolation Method": "Linear",
+            }
+        ]
+    )
+    summary_catalog = ItemCatalog(pd.concat([signals, conditions, pressure]))
+    instance = control_chart_instance(
+        input_signal=widget(["Temperature", "Pressure"]), catalog=summary_catalog
+    )
+
+    plan = create_control_chart(instance, dry_run=True, summary_worksheets=True)
+
+    assert list(plan["worksheets"]) == ["SPC Summary 1", "Histogram Summary 1"]
+    summary = plan["worksheets"]["SPC Summary 1"]
+    assert len(summary) == 2 * 12
+    assert "Pressure: Western Electric Run Rule 4" in summary
+    assert plan["worksheets"]["Histogram Summary 1"] == [
+        "Temperature Histogram",
+        "Pressure Histogram",
+    ]
+
+    workbook = FakeWorkbook()
+    monkeypatch.setattr(
+        templates.spy,
+        "workbooks",
+        SimpleNamespace(
+            pull=lambda *args, **kwargs: [workbook], push=lambda *args, **kwargs: None
+        ),
+    )
+    monkeypatch.setattr(
+        templates.sdk, "WorkbooksApi", lambda client: FakeWorkbooksApi()
+    )
+    # generated items are cataloged by name, like the plan lists them
+    summary_catalog.add(
+        pd.DataFrame(
+            [
+                {"Name": name, "ID": name, "Type": "Signal"}
+                for name in summary
+                if ": " in name
+            ]
+        )
+    )
+
+    templates.create_template(
+        "",
+        {"SPC Summary 1": [name for name in summary if "Run Rule" not in name]},
+        widget(False),
+        widget([]),
+        instance.start_select,
+        instance.end_select,
+        SimpleNamespace(href=None),
+        "workbook",
+        {},
+        summary_catalog,
+        summary=True,
+    )
+
+    display_items = workbook.worksheets["SPC Summary 1"].display_items.set_index("Name")
+    assert display_items.at["Temperature: Mean", "Lane"] == 1
+    assert display_items.at["Pressure: +3 Sigma", "Lane"] == 2
+    assert display_items.at["Pressure", "Axis Group"] == "B"
+    assert templates.axis_group(27) == "AB"
+
+
+class FakeItemsApi:
+    def __init__(self):
+        self.registry = None
+        self.archived = []
+
+    def get_item_and_all_properties(self, id):
+        properties = []
+        if self.registry is not None:
+            properties.append(
+                SimpleNamespace(name=registry.REGISTRY_PROPERTY, value=self.registry)
+            )
+        return SimpleNamespace(properties=properties)
+
+    def set_property(self, id, property_name, body):
+        self.registry = body.value
+
+    def archive_item(self, id, archived_reason):
+        if id == "locked":
+            raise ValueError("Item is locked")
+        self.archived.append(id)
+
+
+def fake_registry(monkeypatch):
+    items_api = FakeItemsApi()
+    archived_worksheets = []
+    monkeypatch.setattr(registry.sdk, "ItemsApi", lambda client: items_api)
+    monkeypatch.setattr(
+        registry.sdk,
+        "WorkbooksApi",
+        lambda client: SimpleNamespace(
+            archive_worksheet=lambda workbook_id, worksheet_id: archived_worksheets.append(
+                worksheet_id
+            )
+        ),
+    )
+    return registry.RunRegistry("workbook"), items_api, archived_worksheets
+
+
+@pytest.mark.unit
+def test_registry_archives_what_later_runs_no_longer_use(monkeypatch):
+    run_registry, items_api, archived_worksheets = fake_registry(monkeypatch)
+    temperature = ["Temperature"]
+    run_registry.register(
+        "first",
+        ["mean", "old-rule", "locked"],
+        ["sheet", "old"],
+        temperature,
+        temperature,
+    )
+    run_registry.register(
+        "second", ["mean", "new-rule"], ["sheet"], temperature, temperature
+    )
+
+    archived = run_registry.archive_superseded()
+
+    assert archived["Runs"] == ["first"]
+    assert sorted(items_api.archived) == ["old-rule"]
+    assert archived_worksheets == ["old"]
+    # the item that failed to archive stays registered for the next cleanup
+    runs = run_registry.runs()
+    assert runs["first"]["Items"] == ["locked"]
+    assert runs["second"]["Items"] == ["mean", "new-rule"]
+
+    limits_df = create_limit_signals(mean_stddev_items(), "Temperature")
+    stamped = stamp_content_hash(limits_df, "2024-01-01", "2024-02-01")
+    tagged = stamp_content_hash(limits_df, "2024-01-01", "2024-02-01", "second")
+    assert (tagged[registry.RUN_ID_PROPERTY] == "second").all()
+    # the run ID does not change the hash, so a rerun still reuses unchanged items
+    assert (tagged[CONTENT_HASH_PROPERTY] == stamped[CONTENT_HASH_PROPERTY]).all()
+
+
+@pytest.mark.unit
+def test_registry_only_supersedes_runs_of_completed_signals(monkeypatch):
+    run_registry, items_api, archived_worksheets = fake_registry(monkeypatch)
+    run_registry.register(
+        "temperature",
+        ["temperature-mean"],
+        ["Temperature Control Chart ID"],
+        ["Temperature"],
+        ["Temperature"],
+    )
+    run_registry.register(
+        "both",
+        ["pressure-old", "temperature-new"],
+        ["Pressure Control Chart ID"],
+        ["Pressure", "Temperature"],
+        ["Temperature"],
+    )
+    run_registry.register(
+        "pressure",
+        ["pressure-mean"],
+        ["Pressure Control Chart ID"],
+        ["Pressure"],
+        ["Pressure"],
+    )
+
+    # the first run is superseded by the Temperature charts of the second one, which stays
+    # registered since the later Pressure run does not cover its Temperature charts
+    assert run_registry.superseded() == ["temperature"]
+    run_registry.archive_superseded()
+
+    assert items_api.archived == ["temperature-mean"]
+    assert archived_worksheets == ["Temperature Control Chart ID"]
+    assert list(run_registry.runs()) == ["both", "pressure"]
+
+    run_registry, items_api, archived_worksheets = fake_registry(monkeypatch)
+    run_registry.register(
+        "temperature", ["temperature-mean"], [], ["Temperature"], ["Temperature"]
+    )
+    run_registry.register("pressure", ["pressure-mean"], [], ["Pressure"], ["Pressure"])
+    assert run_registry.archive_superseded()["Runs"] == []
+    assert items_api.archived == []
+
+
+@pytest.mark.unit
+def test_cancelled_run_registers_what_it_pushed(monkeypatch):
+    run_registry, items_api, _ = fake_registry(monkeypatch)
+    monkeypatch.setattr(backend, "RunRegistry", lambda workbook_id: run_registry)
+    cancel_event = threading.Event()
+
+    def push_items():
+        cancel_event.set()
+        return pd.DataFrame([{"Name": "Temperature: Mean", "ID": "mean-id"}])
+
+    graph = TaskGraph()
+    graph.add("Push Items", push_items)
+    graph.add(
+        "Histograms", lambda items: {"Temperature": "histogram-id"}, ["Push Items"]
+    )
+    with pytest.raises(RunCancelled):
+        graph.run(cancel_event=cancel_event)
+
+    backend.register_run("workbook", "cancelled", graph, ["Temperature"], [], {})
+
+    assert run_registry.runs()["cancelled"]["Items"] == ["mean-id"]
+    # it completed no signal, so it supersedes nothing and any later run of its signal archives it
+    run_registry.register("rerun", ["new-mean"], [], ["Temperature"], ["Temperature"])
+    assert run_registry.archive_superseded()["Items"] == ["mean-id"]
+
+
+@pytest.mark.unit
+def test_registry_merges_the_oldest_runs():
+    runs = {
+        f"run {i}": {
+            "Created": f"2024-01-{i + 1:02d}",
+            "Signals": [f"Signal {i}"],
+            "Completed": [f"Signal {i}"],
+            "Items": [f"item {i}"],
+            "Worksheets": [],
+        }
+        for i in range(5)
+    }
+
+    merged = registry.merge_oldest_runs(runs, max_runs=3)
+
+    assert list(merged) == ["run 3", "run 4", "run 0"]
+    assert merged["run 0"]["Items"] == ["item 0", "item 1", "item 2"]
+    assert merged["run 0"]["Created"] == "2024-01-03"
+
+
+def batch_run(
+    monkeypatch,
+    rejected=(),
+    pushes=None,
+    success=None,
+    on_push=lambda: None,
+    register_run=lambda *args: None,
+    **options,
+):
+    # a batch run of two signals against a fake spy.push that rejects the named items
+    pushes = [] if pushes is None else pushes
+
+    def push(metadata, **kwargs):
+        on_push()
+        pushes.append(kwargs)
+        results = metadata.copy()
+        results["ID"] = results["Name"] + " ID"
+        results["Push Result"] = [
+            "Formula error" if name in rejected else "Success"
+            for name in results["Name"]
+        ]
+        return results
+
+    monkeypatch.setattr(backend, "spy", SimpleNamespace(push=push))
+    monkeypatch.setattr(backend, "existing_item_hashes", lambda workbook_id: {})
+    monkeypatch.setattr(
+        backend,
+        "create_template",
+        lambda URL, display_dict, *args: {name: f"{name} ID" for name in display_dict},
+    )
+    monkeypatch.setattr(backend, "register_run", register_run)
+    pressure = pd.DataFrame(
+        [{"Name": "Pressure", "ID": "pressure-id", "Type": "StoredSignal"}]
+    )
+    if success is None:
+        success = SimpleNamespace(children=[], type="success", value=False)
+    instance = control_chart_instance(
+        catalog=ItemCatalog(pd.concat([signals, pressure, conditions])),
+        input_signal=widget(["Temperature", "Pressure"]),
+        histogram=widget(False),
+        button=SimpleNamespace(disabled=False, loading=False),
+        workbook_button=SimpleNamespace(disabled=True),
+        success=success,
+    )
+    _, success, _, generated_items = create_control_chart(
+        instance, batch_push=True, **options
+    )
+    return pushes, success, generated_items
+
+
+@pytest.mark.unit
+def test_batch_push_only_fails_the_signal_of_a_rejected_item(monkeypatch):
+    pushes, success, generated_items = batch_run(
+        monkeypatch, rejected=["Pressure: Mean"]
+    )
+
+    assert len(pushes) == 1 and pushes[0]["errors"] == "catalog"
+    assert list(generated_items["signals"]) == ["Temperature"]
+    assert "Temperature Control Chart" in generated_items["worksheets"]
+    assert "Pressure Control Chart" not in generated_items["worksheets"]
+    assert success.type == "warning"
+    assert "1 of 2 signals completed" in success.children[0]
+    assert "Failed for Pressure: Push failed: Formula error." in success.children[0]
+
+
+@pytest.mark.unit
+def test_cancelled_run_reports_a_failed_registration(monkeypatch):
+    cancel_event = threading.Event()
+
+    def register_run(*args):
+        raise utils.ApiException(status=503)
+
+    with pytest.raises(RunCancelled, match="Run registry failed"):
+        batch_run(
+            monkeypatch,
+            on_push=cancel_event.set,
+            register_run=register_run,
+            cancel_event=cancel_event,
+        )
+
+    def create_control_chart(instance, **options):
+        raise RunCancelled("Run registry failed: no connection")
+
+    monkeypatch.setattr(backend, "create_control_chart", create_control_chart)
+    app = app_instance()
+    asyncio.run(backend.create_control_chart_async(app))
+    assert app.success.type == "warning"
+    assert app.success.children == [
+        "Run cancelled. Items that were already pushed are kept in the workbook. "
+        "Run registry failed: no connection."
+    ]
+
+
+class ProgressAlert(SimpleNamespace):
+    # success alert that records every message with the number of pushes made before it
+    def __init__(self, pushes):
+        super().__init__(children=[], type="success", value=False, messages=[])
+        self.pushes = pushes
+
+    def __setattr__(self, name, value):
+        if name == "children" and value:
+            self.messages.append((value[0], len(self.pushes)))
+        super().__setattr__(name, value)
+
+
+@pytest.mark.unit
+def test_batch_progress_only_reports_pushed_signals(monkeypatch):
+    pushes = []
+    alert = ProgressAlert(pushes)
+
+    batch_run(monkeypatch, rejected=["Pressure: Mean"], pushes=pushes, success=alert)
+
+    progress = [
+        (message, pushed)
+        for message, pushed in alert.messages
+        if "signals completed. Created" in message and "Formatting" not in message
+    ]
+    assert progress == [
+        (
+            "1 of 2 signals completed. Created Control Chart and Western Electric Run "
+            "Rules for Temperature.",
+            1,
+        )
+    ]
+
+
+def app_instance():
+    # the widgets the async run touches, without pulling the worksheet from a server
+    app = SPCAccelerator.__new__(SPCAccelerator)
+    app.summary_worksheets = widget(True)
+    app.archive_superseded = widget(False)
+    app.button = SimpleNamespace(disabled=True, loading=True)
+    app.cancel_button = SimpleNamespace(disabled=False, loading=True)
+    app.workbook_button = SimpleNamespace(disabled=True)
+    app.success = SimpleNamespace(children=[], type="success", value=False)
+    app.cancel_event = threading.Event()
+    return app
+
+
+@pytest.mark.unit
+def test_async_run_passes_the_run_options_and_resets_the_buttons(monkeypatch):
+    app = app_instance()
+    calls = []
+
+    def create_control_chart(instance, **options):
+        calls.append(options)
+        return instance.workbook_button, instance.success, instance.button, {"run": "1"}
+
+    monkeypatch.setattr(backend, "create_control_chart", create_control_chart)
+
+    asyncio.run(app.run_async())
+
+    assert calls == [{"cancel_event": app.cancel_event, **app.run_options()}]
+    assert calls[0]["summary_worksheets"] and not calls[0]["archive_superseded"]
+    assert app.generated_items == {"run": "1"}
+    assert not app.button.loading and not app.button.disabled
+    assert app.cancel_button.disabled and not app.cancel_button.loading
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("error", [RunCancelled, RuntimeError])
+def test_cancelled_or_failed_async_run_resets_the_buttons(monkeypatch, error):
+    app = app_instance()
+
+    def create_control_chart(instance, **options):
+        app.cancel()
+        assert options["cancel_event"].is_set()
+        raise error("no connection")
+
+    monkeypatch.setattr(backend, "create_control_chart", create_control_chart)
+
+    asyncio.run(app.run_async())
+
+    assert app.success.value
+    if error is RunCancelled:
+        assert app.success.type == "warning"
+        assert app.generated_items is None
+    else:
+        assert app.success.type == "error"
+        assert app.success.children == ["Run failed: no connection"]
+    assert not app.button.loading and not app.button.disabled
+    assert app.cancel_button.disabled and not app.cancel_button.loading